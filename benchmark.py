@@ -0,0 +1,443 @@
+"""
+Benchmarks for the order processing pipeline, one stage at a time.
+
+    python benchmark.py all --orders 1000 5000 --items-per-order 3 10 --json today.json
+    python benchmark.py all --orders 1000 --json today.json --compare yesterday.json
+    python benchmark.py paginate --orders 2000 --latency 0 0.05 0.2 --restore-rate 50
+    python benchmark.py xlsx --rows 10000 100000 1000000
+    python benchmark.py mapping --line-items 100000 500000
+    python benchmark.py formats --rows 100000 1000000
+
+Stages:
+  extract   VendorFormatter.extract_nested_field for every order-level path
+  map       VendorFormatter.map_vendor_data, for each of the sample vendors
+  paginate  FulfillmentOrderPager against fixture_server at several latencies.
+            The fixture's cost bucket restores 1000 points/s by default so the
+            latency and the loop show; --restore-rate 50 matches a standard plan.
+  write     StreamingXlsxWriter on each vendor's rows, column widths included
+  mime      build_draft_message with large attachments
+
+formats compares the output formats a vendor can choose (parquet only when
+pyarrow is installed), with the default size limits, so a big xlsx is split.
+
+Every stage case is timed --repeat times keeping the fastest pass (xlsx and
+mapping once), then run once more under tracemalloc for peak memory, so the tracing overhead doesn't end
+up in the timings.
+--json writes the results, and --compare prints the change against an
+earlier file and exits with status 1 when a case got slower than --threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from writer_module import OUTPUT_FORMATS, StreamingXlsxWriter, open_writer
+
+XLSX_COLUMNS = ["Order ID", "Ship-to Name", "Ship-to Address 1", "Ship-to Address 2", "Ship-to City",
+                "Ship-to State", "Ship-to Zip", "", "SKU Number", "Quantity"]
+
+# Attachment sizes for the mime stage, in MiB
+ATTACHMENT_SIZES = [1, 5, 20]
+
+
+def synthetic_rows(count):
+    return [
+        {
+            "Order ID": f"#{1000 + i // 3}",
+            "Ship-to Name": f"Pat Customer{i // 3}",
+            "Ship-to Address 1": f"{100 + i % 900} Main Street",
+            "Ship-to Address 2": "Suite 4" if i % 5 == 0 else None,
+            "Ship-to City": "Springfield",
+            "Ship-to State": "IL",
+            "Ship-to Zip": f"{62700 + i % 100:05d}",
+            "": "Home",
+            "SKU Number": f"SKU-{i % 5000}",
+            "Quantity": 1 + i % 4,
+        }
+        for i in range(count)
+    ]
+
+
+def synthetic_orders(order_count, items_per_order):
+    # Fulfillment order nodes shaped like the paged query's response
+    from fixture_server import generate_fulfillment_order
+
+    order_nodes = []
+    for index in range(order_count):
+        order_node = generate_fulfillment_order(index, items_per_order)
+        order_node["lineItems"] = {"nodes": order_node["lineItems"]}
+        order_nodes.append(order_node)
+    return order_nodes
+
+
+def synthetic_pages(line_item_count, items_per_order=5, page_size=250):
+    order_nodes = synthetic_orders(-(-line_item_count // items_per_order), items_per_order)
+    return [order_nodes[start:start + page_size] for start in range(0, len(order_nodes), page_size)]
+
+
+def sample_formatters(engine="dict"):
+    """LocationFetchers and formatters for the sample vendors in vendors/, without a state store."""
+    from orderProcessing import DEFAULT_VENDOR_DIR, plan_location_fetches
+    from vendor_module import load_vendors
+
+    location_fetchers = plan_location_fetches(load_vendors(DEFAULT_VENDOR_DIR), engine=engine)
+    return location_fetchers, [formatter for location_fetcher in location_fetchers
+                               for formatter in location_fetcher.formatters]
+
+
+def write_xlsx_pandas(path, rows, columns):
+    # The original writer: DataFrame.to_excel, then reload the workbook to size the columns and save again
+    import pandas as pd
+    from openpyxl import load_workbook
+    from openpyxl.utils import get_column_letter
+
+    df = pd.DataFrame(rows, columns=columns)
+    df.to_excel(path, index=False)
+
+    workbook = load_workbook(path)
+    worksheet = workbook.active
+    for column_cells in worksheet.columns:
+        length = max(len(str(cell.value)) for cell in column_cells) + 2
+        worksheet.column_dimensions[get_column_letter(column_cells[0].column)].width = length
+    workbook.save(path)
+
+
+def write_xlsx_streaming(path, rows, columns):
+    with StreamingXlsxWriter(path, columns) as writer:
+        writer.write_dicts(rows)
+
+
+def write_format(output_format, stem, rows, columns):
+    with open_writer(output_format, stem, columns) as writer:
+        writer.write_dicts(rows)
+    return writer.paths
+
+
+def measure(function, *args, trace_memory=True, repeat=1):
+    """Returns (fastest seconds, peak traced bytes or None, the function's return value)."""
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function(*args)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return seconds, peak, value
+
+
+def result(stage, case, seconds, peak, **details):
+    return {"stage": stage, "case": str(case), "seconds": round(seconds, 4),
+            "peak_mib": round(peak / 1024 / 1024, 2) if peak is not None else None, **details}
+
+
+def result_key(entry):
+    # Identifies the same case across runs
+    return (entry["stage"], entry["case"], entry.get("orders"), entry.get("items_per_order"),
+            entry.get("rows"), entry.get("line_items"))
+
+
+def benchmark_extract(order_nodes, repeat, details):
+    results = []
+    for formatter in sample_formatters()[1]:
+        field_paths = [field_path for column_name, field_path in formatter.order_fields]
+
+        def extract_all():
+            for order_node in order_nodes:
+                for field_path in field_paths:
+                    formatter.extract_nested_field(order_node, field_path)
+            return len(order_nodes) * len(field_paths)
+
+        seconds, peak, calls = measure(extract_all, repeat=repeat)
+        results.append(result("extract", formatter.vendor_name, seconds, peak, calls=calls,
+                              ns_per_call=round(seconds / max(calls, 1) * 1e9), **details))
+    return results
+
+
+def benchmark_map(order_nodes, repeat, details):
+    results = []
+    for formatter in sample_formatters()[1]:
+        def map_all():
+            return sum(len(formatter.map_vendor_data(order_node)) for order_node in order_nodes)
+
+        seconds, peak, rows = measure(map_all, repeat=repeat)
+        results.append(result("map", formatter.vendor_name, seconds, peak, rows=rows, **details))
+    return results
+
+
+def benchmark_paginate(order_count, items_per_order, latencies, restore_rate, details):
+    from fixture_server import FixtureServer
+    from shopify_module import FulfillmentOrderPager, ShopifyRateBudget, ShopifyTransport
+
+    location_fetcher = sample_formatters()[0][0]
+    query, fulfillment_order_fields, line_item_fields = location_fetcher.build_queries()
+
+    results = []
+    for latency in latencies:
+        with FixtureServer(orders=order_count, items_per_order=items_per_order, latency=latency,
+                           restore_rate=restore_rate) as server:
+            def fetch_all():
+                # A fresh transport and cost bucket per pass so passes don't throttle each other
+                transport = ShopifyTransport(server.url, "benchmark",
+                                             budget=ShopifyRateBudget(restore_rate=restore_rate))
+                pager = FulfillmentOrderPager(location_fetcher.location_id, query, line_item_fields,
+                                              transport=transport)
+                pages = sum(1 for page in pager.pages())
+                return pages, transport.latency_stats()
+
+            # Network-bound, so only timed
+            seconds, peak, (pages, stats) = measure(fetch_all, trace_memory=False)
+            results.append(result("paginate", f"latency {latency}s, restore {restore_rate:g}/s", seconds, peak,
+                                  pages=pages, requests=stats["requests"], throttled=stats["throttled"], **details))
+    return results
+
+
+def benchmark_write(order_nodes, repeat, details):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for formatter in sample_formatters()[1]:
+            rows = [row for order_node in order_nodes for row in formatter.map_vendor_data(order_node)]
+            path = os.path.join(directory, f"{formatter.output_filename}.xlsx")
+            seconds, peak, _ = measure(write_xlsx_streaming, path, rows, formatter.columns_order, repeat=repeat)
+            results.append(result("write", formatter.vendor_name, seconds, peak, rows=len(rows),
+                                  file_kib=round(os.path.getsize(path) / 1024), **details))
+    return results
+
+
+def benchmark_mime(attachment_sizes, repeat=1):
+    from email_module import build_draft_message
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in attachment_sizes:
+            path = os.path.join(directory, f"attachment_{size}.xlsx")
+            # Random bytes, since a real workbook is already zip-compressed
+            with open(path, "wb") as file:
+                file.write(os.urandom(size * 1024 * 1024))
+
+            seconds, peak, draft = measure(build_draft_message, ["vendor@example.com"], "Orders", "Body",
+                                           "<p>Signature</p>", path, ["cc@example.com"], repeat=repeat)
+            results.append(result("mime", f"{size} MiB", seconds, peak,
+                                  draft_mib=round(len(draft["message"]["raw"]) / 1024 / 1024, 1)))
+    return results
+
+
+def benchmark_stages(stages, order_counts, items_per_order_counts, latencies, restore_rate, repeat):
+    results = []
+    for order_count in order_counts:
+        for items_per_order in items_per_order_counts:
+            details = {"orders": order_count, "items_per_order": items_per_order}
+            order_nodes = synthetic_orders(order_count, items_per_order)
+            if "extract" in stages:
+                results.extend(benchmark_extract(order_nodes, repeat, details))
+            if "map" in stages:
+                results.extend(benchmark_map(order_nodes, repeat, details))
+            if "paginate" in stages:
+                results.extend(benchmark_paginate(order_count, items_per_order, latencies, restore_rate, details))
+            if "write" in stages:
+                results.extend(benchmark_write(order_nodes, repeat, details))
+
+    if "mime" in stages:
+        results.extend(benchmark_mime(ATTACHMENT_SIZES, repeat))
+    return results
+
+
+def benchmark_xlsx(row_counts):
+    writers = [("pandas + openpyxl reload", write_xlsx_pandas), ("streaming", write_xlsx_streaming)]
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for row_count in row_counts:
+            rows = synthetic_rows(row_count)
+            for name, writer in writers:
+                path = os.path.join(directory, f"{row_count}.xlsx")
+                seconds, peak, _ = measure(writer, path, rows, XLSX_COLUMNS)
+                results.append(result("xlsx", name, seconds, peak, rows=row_count,
+                                      file_kib=round(os.path.getsize(path) / 1024)))
+    return results
+
+
+def benchmark_formats(row_counts):
+    try:
+        import pyarrow  # noqa: F401
+        output_formats = list(OUTPUT_FORMATS)
+    except ImportError:
+        output_formats = [output_format for output_format in OUTPUT_FORMATS if output_format != "parquet"]
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for row_count in row_counts:
+            rows = synthetic_rows(row_count)
+            for output_format in output_formats:
+                stem = os.path.join(directory, f"{row_count}_{output_format}")
+                seconds, peak, paths = measure(write_format, output_format, stem, rows, XLSX_COLUMNS)
+                results.append(result("formats", output_format, seconds, peak, rows=row_count, files=len(paths),
+                                      file_kib=round(sum(os.path.getsize(path) for path in paths) / 1024)))
+    return results
+
+
+def map_pages(engine, pages):
+    # Maps every page for the sample vendors, the way LocationFetcher fans pages out
+    location_fetchers, formatters = sample_formatters(engine)
+    for location_fetcher in location_fetchers:
+        for order_nodes in pages:
+            location_fetcher.distribute(order_nodes)
+    return formatters
+
+
+def formatter_rows(formatter):
+    rows = [tuple(row.get(column) for column in formatter.columns_order) for row in formatter.flattened_data]
+    for frame in formatter.frames:
+        rows.extend(frame.itertuples(index=False, name=None))
+    return rows
+
+
+def benchmark_mapping(line_item_counts):
+    # Import both engines up front so neither timing includes module imports
+    import pandas  # noqa: F401
+    import orderProcessing  # noqa: F401
+
+    results = []
+
+    for line_item_count in line_item_counts:
+        pages = synthetic_pages(line_item_count)
+        outputs = {}
+        for engine in ("dict", "columnar"):
+            seconds, peak, formatters = measure(map_pages, engine, pages)
+            outputs[engine] = [formatter_rows(formatter) for formatter in formatters]
+            results.append(result("mapping", engine, seconds, peak, line_items=line_item_count,
+                                  vendors=len(formatters), rows=sum(map(len, outputs[engine]))))
+
+        # Both engines have to produce exactly the same rows
+        if outputs["dict"] != outputs["columnar"]:
+            raise AssertionError(f"Engines disagree at {line_item_count} line items")
+
+    return results
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *rows)]
+    print("  ".join(str(header).ljust(width) for header, width in zip(headers, widths)))
+    print("  ".join("-" * width for width in widths))
+    for row in rows:
+        print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+
+def print_results(results):
+    # Columns in the order they first appear, "-" where a stage doesn't report one
+    headers = []
+    for entry in results:
+        headers.extend(key for key in entry if key not in headers)
+    print_table(headers, [["-" if entry.get(header) is None else entry.get(header) for header in headers]
+                          for entry in results])
+
+
+def write_report(path, results, arguments):
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "arguments": arguments,
+        "results": results,
+    }
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+def compare_results(results, previous_path, threshold):
+    """Print each case's change against an earlier --json file. Returns the number of regressions."""
+    with open(previous_path) as file:
+        previous = {result_key(entry): entry for entry in json.load(file)["results"]}
+
+    rows = []
+    regressions = 0
+    for entry in results:
+        before = previous.get(result_key(entry))
+        if before is None or not before["seconds"]:
+            continue
+        change = entry["seconds"] / before["seconds"] - 1
+        verdict = ""
+        if change > threshold:
+            verdict = "SLOWER"
+            regressions += 1
+        elif change < -threshold:
+            verdict = "faster"
+        rows.append([entry["stage"], entry["case"], entry.get("orders", "-"), entry.get("items_per_order", "-"),
+                     f"{before['seconds']:.3f}", f"{entry['seconds']:.3f}", f"{change:+.0%}", verdict])
+
+    print(f"\nCompared with {previous_path}:")
+    print_table(["Stage", "Case", "Orders", "Items", "Before", "After", "Change", ""], rows)
+    return regressions
+
+
+if __name__ == "__main__":
+    output_parser = argparse.ArgumentParser(add_help=False)
+    output_parser.add_argument("--json", help="write the results to this file")
+    output_parser.add_argument("--compare", help="an earlier --json file to compare against")
+    output_parser.add_argument("--threshold", type=float, default=0.20,
+                               help="slowdown that counts as a regression (default 0.20 = 20%%)")
+
+    repeat_parser = argparse.ArgumentParser(add_help=False)
+    repeat_parser.add_argument("--repeat", type=int, default=5, help="timed passes per case, the fastest is kept")
+
+    stage_parser = argparse.ArgumentParser(add_help=False, parents=[repeat_parser])
+    stage_parser.add_argument("--orders", type=int, nargs="+", default=[1000])
+    stage_parser.add_argument("--items-per-order", type=int, nargs="+", default=[3])
+    stage_parser.add_argument("--latency", type=float, nargs="+", default=[0.0, 0.05, 0.2],
+                              help="fixture server latencies for the paginate stage, in seconds")
+    stage_parser.add_argument("--restore-rate", type=float, default=1000.0,
+                              help="cost points the fixture server restores per second")
+
+    parser = argparse.ArgumentParser(description="Benchmark stages of the order processing pipeline.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    subparsers.add_parser("all", parents=[stage_parser, output_parser], help="every stage below")
+    subparsers.add_parser("extract", parents=[stage_parser, output_parser], help="extract_nested_field")
+    subparsers.add_parser("map", parents=[stage_parser, output_parser], help="map_vendor_data per sample vendor")
+    subparsers.add_parser("paginate", parents=[stage_parser, output_parser],
+                          help="the pagination loop against the local fixture server")
+    subparsers.add_parser("write", parents=[stage_parser, output_parser], help="XLSX for each vendor's rows")
+    subparsers.add_parser("mime", parents=[repeat_parser, output_parser], help="MIME assembly with large attachments")
+
+    xlsx_parser = subparsers.add_parser("xlsx", parents=[output_parser],
+                                        help="XLSX generation, the original writer against the streaming one")
+    xlsx_parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+
+    formats_parser = subparsers.add_parser("formats", parents=[output_parser],
+                                           help="Each output format through open_writer, as write_output uses them")
+    formats_parser.add_argument("--rows", type=int, nargs="+", default=[100000, 1000000])
+
+    mapping_parser = subparsers.add_parser("mapping", parents=[output_parser],
+                                           help="Mapping pages of orders into vendor rows, dict vs columnar")
+    mapping_parser.add_argument("--line-items", type=int, nargs="+", default=[100000, 500000])
+
+    args = parser.parse_args()
+    if args.benchmark == "xlsx":
+        run_results = benchmark_xlsx(args.rows)
+    elif args.benchmark == "formats":
+        run_results = benchmark_formats(args.rows)
+    elif args.benchmark == "mapping":
+        run_results = benchmark_mapping(args.line_items)
+    elif args.benchmark == "mime":
+        run_results = benchmark_mime(ATTACHMENT_SIZES, args.repeat)
+    else:
+        selected_stages = ["extract", "map", "paginate", "write", "mime"] if args.benchmark == "all" else [args.benchmark]
+        run_results = benchmark_stages(selected_stages, args.orders, args.items_per_order, args.latency,
+                                       args.restore_rate, args.repeat)
+
+    print_results(run_results)
+    if args.json:
+        write_report(args.json, run_results, vars(args))
+    if args.compare and compare_results(run_results, args.compare, args.threshold):
+        sys.exit(1)
@@ -0,0 +1,68 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+CACHE_MODES = ("off", "record", "replay")
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ResponseCache:
+    """
+    On-disk cache of Shopify GraphQL responses for offline, repeatable runs.
+
+    In "record" mode every successful response is saved as a gzipped JSON file
+    named after a hash of the query text and its variables (the cursor and page
+    size included). In "replay" mode those files are served back instead of
+    calling Shopify, so a recorded run can be repeated with no network.
+    """
+    def __init__(self, directory="shopify_cache", mode="record"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode {mode!r}, expected one of {', '.join(CACHE_MODES)}")
+        self.directory = directory
+        self.mode = mode
+
+    @staticmethod
+    def key(query, variables):
+        # Whitespace in the query text doesn't change the request, so it doesn't change the key
+        normalized_query = " ".join(query.split())
+        payload = json.dumps({"query": normalized_query, "variables": variables}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json.gz")
+
+    def load(self, query, variables):
+        key = self.key(query, variables)
+        try:
+            with gzip.open(self.path(key), "rt", encoding="utf-8") as file:
+                return json.load(file)["response"]
+        except FileNotFoundError:
+            raise CacheMissError(f"No recorded response for {key} (variables: {json.dumps(variables)[:200]})") from None
+
+    def save(self, query, variables, response):
+        key = self.key(query, variables)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so a crash never leaves half a response behind
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as raw_file, gzip.open(raw_file, "wt", encoding="utf-8") as file:
+                json.dump({"query": query, "variables": variables, "response": response}, file)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+
+def cache_from_env():
+    """The cache configured by SHOPIFY_CACHE_MODE and SHOPIFY_CACHE_DIR, or None when it's off."""
+    mode = os.getenv("SHOPIFY_CACHE_MODE", "off")
+    if mode == "off":
+        return None
+    return ResponseCache(os.getenv("SHOPIFY_CACHE_DIR", "shopify_cache"), mode)
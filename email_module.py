@@ -2,13 +2,26 @@ import base64
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.http import BatchHttpRequest
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
+from metrics_module import metrics
+from writer_module import DEFAULT_MAX_FILE_BYTES
+
+# Vendors can be processed on several threads; only one of them should refresh token.json at a time
+_auth_lock = threading.Lock()
 
 def authenticate_gmail_api():
+    # Offline runs against the fake Gmail server in fixture_server.py don't need a Google login
+    if os.getenv("GMAIL_OFFLINE") == "1":
+        return AnonymousCredentials()
+
     # Load in Gmail API credentials
     creds = None
     if os.path.exists('token.json'):
@@ -28,37 +41,219 @@ def authenticate_gmail_api():
 
     return creds
 
-def create_and_draft_email(to_email, subject, body, signature, attachment_path, cc_emails, vendor):
-    if os.path.exists(f'{attachment_path}'):
-        # Authenticate with the API
-        creds = authenticate_gmail_api()
-        service = build('gmail','v1', credentials=creds)
+def build_gmail_service(creds, api_endpoint=None):
+    # api_endpoint points the client at another Gmail server, e.g. the local fake in fixture_server.py
+    client_options = {"api_endpoint": api_endpoint} if api_endpoint else None
+    return build('gmail','v1', credentials=creds, client_options=client_options)
 
-        message = MIMEMultipart()
-        message['to'] = ', '.join(to_email)
-        message['subject'] = subject
-        message['Cc'] = ', '.join(cc_emails)
+def build_draft_message(to_email, subject, body, signature, attachment_paths, cc_emails):
+    """Assemble the MIME message, with one or more files attached, and return it as a drafts().create request body."""
+    if isinstance(attachment_paths, str):
+        attachment_paths = [attachment_paths]
 
-        body_text_part = MIMEText(body, 'plain')
-        message.attach(body_text_part)
+    message = MIMEMultipart()
+    message['to'] = ', '.join(to_email)
+    message['subject'] = subject
+    message['Cc'] = ', '.join(cc_emails)
 
-        body_html_part = MIMEText(signature, 'html')
-        message.attach(body_html_part)
+    body_text_part = MIMEText(body, 'plain')
+    message.attach(body_text_part)
 
-        # Attach the file
+    body_html_part = MIMEText(signature, 'html')
+    message.attach(body_html_part)
+
+    # Attach the file(s)
+    for attachment_path in attachment_paths:
         with open(attachment_path, 'rb') as file:
             attach = MIMEApplication(file.read(), Name=os.path.basename(attachment_path))
             attach.add_header('Content-Disposition', f'attachment; filename={os.path.basename(attachment_path)}')
             message.attach(attach)
 
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode("utf-8")
+    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode("utf-8")
+    return {'message': {'raw': raw_message}}
+
+def group_attachments(attachment_paths, max_bytes=DEFAULT_MAX_FILE_BYTES):
+    """
+    Split the files that exist into groups of at most max_bytes, in order, one
+    group per draft. A file bigger than max_bytes gets a draft of its own.
+    """
+    groups = []
+    group_bytes = 0
+    for attachment_path in attachment_paths:
+        if not os.path.exists(attachment_path):
+            continue
+        file_bytes = os.path.getsize(attachment_path)
+        if not groups or group_bytes + file_bytes > max_bytes:
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append(attachment_path)
+        group_bytes += file_bytes
+    return groups
+
+
+def draft_subject(subject, index, count):
+    # "Orders 03-15 (2 of 3)" when the files didn't fit in one draft
+    return subject if count == 1 else f"{subject} ({index + 1} of {count})"
+
+
+def create_and_draft_email(to_email, subject, body, signature, attachment_paths, cc_emails, vendor):
+    if isinstance(attachment_paths, str):
+        attachment_paths = [attachment_paths]
+    groups = group_attachments(attachment_paths)
+    if groups:
+        # Authenticate with the API
+        with _auth_lock:
+            creds = authenticate_gmail_api()
+        service = build_gmail_service(creds, os.getenv("GMAIL_API_ENDPOINT"))
+
+        for i, group in enumerate(groups):
+            create_message = build_draft_message(to_email, draft_subject(subject, i, len(groups)), body, signature,
+                                                 group, cc_emails)
+
+            # Draft the email
+            try:
+                service.users().drafts().create(userId="me", body=create_message).execute()
+                print(f"Email to {vendor} successfully created, continuing...")
+            except Exception as e:
+                print(f"Error creating email: {e}")
+    else:
+        print(f"No file present, skipping email to {vendor}...")
+
+
+class GmailMailer:
+    """
+    Drafts emails for a whole run with one Gmail client.
+
+    Credentials and the Gmail service are created once, on first use.
+    queue_draft() assembles the message and returns straight away; drafts are
+    sent to Gmail's batch endpoint in groups of batch_size (or max_batch_bytes)
+    on a background thread, so drafting overlaps with the next vendor's work.
+    A vendor's files are spread over several drafts when together they're
+    bigger than max_attachment_bytes.
+    flush() sends whatever is left, waits, and returns {vendor: error or None},
+    the error being the first failed draft's. flush(vendors) only waits for
+    those vendors' drafts, so runs sharing the mailer don't wait for, or take,
+    each other's results.
+    """
+    def __init__(self, batch_size=10, max_batch_bytes=20 * 1024 * 1024, creds=None, api_endpoint=None,
+                 max_attachment_bytes=DEFAULT_MAX_FILE_BYTES):
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_attachment_bytes = max_attachment_bytes
+        self.creds = creds
+        self.api_endpoint = api_endpoint
+        self.service = None
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        # vendor -> futures of the batches holding its drafts, until flushed
+        self.vendor_futures = {}
+        self.results = {}
+        # One sender thread: the Gmail client isn't thread-safe, so only this thread touches it
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def get_service(self):
+        if self.service is None:
+            with metrics.timer("gmail_auth", "gmail"):
+                if self.creds is None:
+                    with _auth_lock:
+                        self.creds = authenticate_gmail_api()
+                self.service = build_gmail_service(self.creds, self.api_endpoint)
+        return self.service
+
+    def queue_draft(self, to_email, subject, body, signature, attachment_paths, cc_emails, vendor):
+        if isinstance(attachment_paths, str):
+            attachment_paths = [attachment_paths]
+        groups = group_attachments(attachment_paths, self.max_attachment_bytes)
+        if not groups:
+            print(f"No file present, skipping email to {vendor}...")
+            return
 
-        # Draft the email
+        for i, group in enumerate(groups):
+            with metrics.timer("mime", vendor):
+                create_message = build_draft_message(to_email, draft_subject(subject, i, len(groups)), body,
+                                                     signature, group, cc_emails)
+            self.queue_message(vendor, create_message)
+
+    def queue_message(self, vendor, create_message):
+        message_bytes = len(create_message['message']['raw'])
+        metrics.increment("draft_bytes", message_bytes, scope=vendor)
+
+        with self.lock:
+            # Keep batches under the size limit; a batch always holds at least one draft
+            if self.pending and self.pending_bytes + message_bytes > self.max_batch_bytes:
+                self.submit_pending()
+            self.pending.append((vendor, create_message))
+            self.pending_bytes += message_bytes
+            if len(self.pending) >= self.batch_size:
+                self.submit_pending()
+
+    def submit_pending(self):
+        # Called with self.lock held
+        batch, self.pending, self.pending_bytes = self.pending, [], 0
+        future = self.executor.submit(self.send_batch, batch)
+        for vendor in {vendor for vendor, create_message in batch}:
+            self.vendor_futures.setdefault(vendor, []).append(future)
+
+    def send_batch(self, batch):
         try:
-            create_message = {'message': {'raw': raw_message}}
-            service.users().drafts().create(userId="me", body=create_message).execute()
-            print(f"Email to {vendor} successfully created, continuing...")
+            service = self.get_service()
         except Exception as e:
-            print(f"Error creating email: {e}")
-    else:
-        print(f"No file present, skipping email to {vendor}...")
\ No newline at end of file
+            for vendor, create_message in batch:
+                self.record_result(vendor, e)
+            return
+
+        def callback(request_id, response, exception):
+            self.record_result(batch[int(request_id)][0], exception)
+
+        if self.api_endpoint:
+            batch_request = BatchHttpRequest(callback=callback, batch_uri=f"{self.api_endpoint.rstrip('/')}/batch/gmail/v1")
+        else:
+            batch_request = service.new_batch_http_request(callback=callback)
+        for i, (vendor, create_message) in enumerate(batch):
+            batch_request.add(service.users().drafts().create(userId="me", body=create_message), request_id=str(i))
+
+        try:
+            with metrics.timer("gmail_batch", "gmail"):
+                batch_request.execute()
+        except Exception as e:
+            # The whole batch request failed, e.g. a network error
+            for vendor, create_message in batch:
+                self.record_result(vendor, e)
+
+    def record_result(self, vendor, error):
+        with self.lock:
+            # A vendor with several drafts keeps the first failure
+            if self.results.get(vendor) is None:
+                self.results[vendor] = error
+        metrics.increment("drafts_created" if error is None else "drafts_failed", scope=vendor)
+        if error is None:
+            print(f"Email to {vendor} successfully created, continuing...")
+        else:
+            print(f"Error creating email to {vendor}: {error}")
+
+    def flush(self, vendors=None):
+        """
+        Send what's left and wait. With vendors, only their drafts are waited
+        for and only their results are returned; they're forgotten afterwards,
+        so a long-lived mailer starts each cycle clean.
+        """
+        with self.lock:
+            if vendors is None:
+                vendors = list(self.vendor_futures) + [vendor for vendor, create_message in self.pending]
+                return_all = True
+            else:
+                return_all = False
+            if any(vendor in vendors for vendor, create_message in self.pending):
+                self.submit_pending()
+            futures = {future for vendor in vendors for future in self.vendor_futures.pop(vendor, [])}
+        for future in futures:
+            future.result()
+        with self.lock:
+            if return_all:
+                return dict(self.results)
+            return {vendor: self.results.pop(vendor) for vendor in vendors if vendor in self.results}
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
@@ -0,0 +1,466 @@
+"""
+Local stand-in for the Shopify Admin GraphQL endpoint.
+
+Serves generated fulfillmentOrders pages with realistic extensions.cost /
+throttleStatus metadata, and answers the aliased node() queries used to fetch
+the remaining line items of long orders. Bulk operations are simulated too:
+bulkOperationRunQuery starts an operation that completes after bulk_delay
+seconds, and its JSONL result is served from /bulk/<id>.jsonl. An
+"id:>=<number>" filter in the bulk query is applied to the result.
+
+Responses can be slowed down with `latency`, and `throttle_every` makes every
+Nth GraphQL request fail with HTTP 429 and a Retry-After header, on top of the
+THROTTLED errors the cost bucket produces by itself.
+
+FakeGmailServer does the same for Gmail: it accepts drafts().create calls,
+singly or through the batch endpoint, so email_module can run offline with
+GMAIL_API_ENDPOINT pointing at it.
+
+Point ENDPOINT_URL at it to run the script without a live store:
+
+    python fixture_server.py --orders 500 --port 8000
+    ENDPOINT_URL=http://127.0.0.1:8000/graphql.json python orderProcessing.py
+
+For a fully offline run, add --gmail-port and set GMAIL_API_ENDPOINT to the
+printed URL with GMAIL_OFFLINE=1. Running once with SHOPIFY_CACHE_MODE=record
+saves the responses, and SHOPIFY_CACHE_MODE=replay then repeats the run
+without the server.
+"""
+import argparse
+import gzip
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIRST_ARGUMENT = re.compile(r"lineItems\(first: (\d+), after: \$after(\d+)\)")
+
+
+def generate_fulfillment_order(index, items_per_order, long_order_every=0, long_order_items=60):
+    item_count = items_per_order
+    if long_order_every and index % long_order_every == long_order_every - 1:
+        item_count = long_order_items
+
+    address = {
+        "address1": f"{100 + index} Main Street",
+        "address2": "Suite 4" if index % 3 == 0 else None,
+        "company": None,
+        "city": "Springfield",
+        "countryCode": "US",
+        "firstName": "Pat",
+        "lastName": f"Customer{index}",
+        "name": f"Pat Customer{index}",
+        "phone": "555-0100",
+        "provinceCode": "IL",
+        "zip": f"{62700 + index % 100:05d}",
+    }
+    return {
+        "id": f"gid://shopify/FulfillmentOrder/{5000000 + index}",
+        "assignedLocation": {"name": "Warehouse"},
+        "order": {
+            "id": f"gid://shopify/Order/{4000000 + index}",
+            "name": f"#{1000 + index}",
+            "billingAddress": dict(address),
+            "customer": {"id": f"gid://shopify/Customer/{3000000 + index}", "email": f"customer{index}@example.com"},
+            "shippingAddress": dict(address),
+            "shippingLine": {"title": "Standard Shipping"},
+        },
+        "status": "OPEN",
+        "createdAt": f"2024-01-{1 + index % 28:02d}T12:00:00Z",
+        "lineItems": [
+            {
+                "sku": f"SKU-{index}-{item}",
+                "totalQuantity": 1 + item % 4,
+                "productTitle": f"Product {item}",
+                # Roughly one in ten items is digital and gets filtered out
+                "requiresShipping": item % 10 != 9,
+            }
+            for item in range(item_count)
+        ],
+    }
+
+
+class ThrottleBucket:
+    """Same leaky bucket model Shopify uses for GraphQL query cost."""
+    def __init__(self, maximum_available=1000.0, restore_rate=50.0):
+        self.maximum_available = maximum_available
+        self.restore_rate = restore_rate
+        self.currently_available = maximum_available
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def spend(self, requested_cost, actual_cost):
+        """Returns False when the query has to be throttled."""
+        with self.lock:
+            now = time.monotonic()
+            self.currently_available = min(self.maximum_available,
+                                           self.currently_available + (now - self.last_update) * self.restore_rate)
+            self.last_update = now
+            if requested_cost > self.currently_available:
+                return False
+            self.currently_available -= actual_cost
+            return True
+
+    def status(self):
+        return {
+            "maximumAvailable": self.maximum_available,
+            "currentlyAvailable": int(self.currently_available),
+            "restoreRate": self.restore_rate,
+        }
+
+
+class FixtureServer:
+    """
+    Threaded HTTP server generating `orders` fulfillment orders. Every
+    `long_order_every`-th order has `long_order_items` line items so the
+    nested line item pagination gets exercised.
+    Use as a context manager or call start()/stop(); `url` is the endpoint.
+    """
+    def __init__(self, orders=50, items_per_order=3, long_order_every=0, long_order_items=60,
+                 host="127.0.0.1", port=0, maximum_available=1000.0, restore_rate=50.0, bulk_delay=1.0,
+                 latency=0.0, throttle_every=0, retry_after=1):
+        self.order_settings = (items_per_order, long_order_every, long_order_items)
+        self.orders = [generate_fulfillment_order(i, *self.order_settings) for i in range(orders)]
+        self.orders_by_id = {order["id"]: order for order in self.orders}
+        self.bucket = ThrottleBucket(maximum_available, restore_rate)
+        self.request_count = 0
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.count_lock = threading.Lock()
+        self.bulk_delay = bulk_delay
+        self.bulk_operations = {}
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.thread = None
+
+    def add_orders(self, count):
+        """Append count new fulfillment orders, as if they arrived since the last poll."""
+        new_orders = [generate_fulfillment_order(i, *self.order_settings)
+                      for i in range(len(self.orders), len(self.orders) + count)]
+        self.orders_by_id.update((order["id"], order) for order in new_orders)
+        self.orders.extend(new_orders)
+        return new_orders
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def url(self):
+        return f"{self.base_url}/graphql.json"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def make_handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if fixture.latency:
+                    time.sleep(fixture.latency)
+
+                with fixture.count_lock:
+                    fixture.request_count += 1
+                    request_number = fixture.request_count
+                if fixture.throttle_every and request_number % fixture.throttle_every == 0:
+                    self.send_json(429, {"errors": "Exceeded 2 calls per second for api client."},
+                                   {"Retry-After": str(fixture.retry_after)})
+                    return
+
+                status, payload = fixture.handle_graphql(json.loads(body))
+                self.send_json(status, payload)
+
+            def do_GET(self):
+                match = re.fullmatch(r"/bulk/(\d+)\.jsonl", self.path)
+                if not match or int(match.group(1)) not in fixture.bulk_operations:
+                    self.send_json(404, {"errors": "Not Found"})
+                    return
+                deadline, orders = fixture.bulk_operations[int(match.group(1))]
+
+                # Stream the file without a length, like a large download from Shopify's storage
+                self.send_response(200)
+                self.send_header("Content-Type", "application/jsonl")
+                self.end_headers()
+                for line in fixture.bulk_jsonl_lines(orders):
+                    self.wfile.write(line.encode("utf-8") + b"\n")
+
+            def send_json(self, status, payload, extra_headers=None):
+                encoded = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if "gzip" in self.headers.get("Accept-Encoding", "") and len(encoded) > 1024:
+                    encoded = gzip.compress(encoded)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(encoded)))
+                for name, value in (extra_headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def handle_graphql(self, request_body):
+        query = request_body["query"]
+        variables = request_body.get("variables") or {}
+
+        if "bulkOperationRunQuery" in query:
+            data, requested_cost, actual_cost = self.start_bulk_operation(variables.get("query", ""))
+        elif "on BulkOperation" in query:
+            data, requested_cost, actual_cost = self.bulk_operation_status(variables["id"])
+        elif "fulfillmentOrders(" in query:
+            data, requested_cost, actual_cost = self.fulfillment_orders_page(variables, "lineItems(" in query)
+        elif "node(id:" in query:
+            data, requested_cost, actual_cost = self.remaining_line_items(query, variables)
+        else:
+            return 400, {"errors": [{"message": "Query not supported by the fixture server"}]}
+
+        if not self.bucket.spend(requested_cost, actual_cost):
+            return 200, {
+                "errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+                "extensions": {"cost": {"requestedQueryCost": requested_cost, "actualQueryCost": None,
+                                        "throttleStatus": self.bucket.status()}},
+            }
+
+        return 200, {
+            "data": data,
+            "extensions": {"cost": {"requestedQueryCost": requested_cost, "actualQueryCost": actual_cost,
+                                    "throttleStatus": self.bucket.status()}},
+        }
+
+    def line_items_connection(self, order, first, after):
+        start = int(after) if after else 0
+        items = order["lineItems"][start:start + first]
+        end = start + len(items)
+        return {
+            "pageInfo": {"hasNextPage": end < len(order["lineItems"]), "endCursor": str(end) if items else after},
+            "nodes": [dict(item) for item in items],
+        }
+
+    def fulfillment_orders_page(self, variables, with_line_items=True):
+        first = variables.get("first", 5)
+        # A query selecting only pageInfo doesn't pay for line items
+        line_items_first = variables.get("lineItemsFirst", 25) if with_line_items else 0
+        start = int(variables["after"]) if variables.get("after") else 0
+        page = self.orders[start:start + first]
+        end = start + len(page)
+
+        nodes = []
+        for order in page:
+            node = {key: value for key, value in order.items() if key != "lineItems"}
+            node["lineItems"] = self.line_items_connection(order, line_items_first, None)
+            nodes.append(node)
+
+        data = {"fulfillmentOrders": {
+            "nodes": nodes,
+            "pageInfo": {"endCursor": str(end) if page else variables.get("after"), "hasNextPage": end < len(self.orders)},
+            "edges": [{"cursor": str(start + i + 1)} for i in range(len(page))],
+        }}
+        # Shopify charges a connection by its requested size, and refunds what wasn't returned
+        requested_cost = 2 + first * (3 + line_items_first)
+        actual_cost = 2 + sum(3 + len(node["lineItems"]["nodes"]) for node in nodes)
+        return data, requested_cost, actual_cost
+
+    def remaining_line_items(self, query, variables):
+        data = {}
+        requested_cost = 0
+        actual_cost = 0
+        for first, alias_index in FIRST_ARGUMENT.findall(query):
+            order = self.orders_by_id.get(variables[f"id{alias_index}"])
+            if order is None:
+                data[f"fo{alias_index}"] = None
+                continue
+            connection = self.line_items_connection(order, int(first), variables.get(f"after{alias_index}"))
+            data[f"fo{alias_index}"] = {"lineItems": connection}
+            requested_cost += 3 + int(first)
+            actual_cost += 3 + len(connection["nodes"])
+        return data, requested_cost, actual_cost
+
+    def start_bulk_operation(self, bulk_query):
+        operation_number = len(self.bulk_operations) + 1
+        minimum_id = re.search(r"id:>=(\d+)", bulk_query)
+        orders = [order for order in self.orders
+                  if not minimum_id or int(order["id"].split("/")[-1]) >= int(minimum_id.group(1))]
+        # The result is the orders as they were when the operation started
+        self.bulk_operations[operation_number] = (time.monotonic() + self.bulk_delay, orders)
+        operation = {"id": f"gid://shopify/BulkOperation/{operation_number}", "status": "CREATED"}
+        return {"bulkOperationRunQuery": {"bulkOperation": operation, "userErrors": []}}, 10, 10
+
+    def bulk_operation_status(self, operation_id):
+        operation_number = int(operation_id.split("/")[-1])
+        deadline, orders = self.bulk_operations[operation_number]
+        finished = time.monotonic() >= deadline
+        operation = {
+            "id": operation_id,
+            "status": "COMPLETED" if finished else "RUNNING",
+            "errorCode": None,
+            "objectCount": str(sum(1 + len(order["lineItems"]) for order in orders)) if finished else "0",
+            "url": f"{self.base_url}/bulk/{operation_number}.jsonl" if finished and orders else None,
+        }
+        return {"node": operation}, 1, 1
+
+    def bulk_jsonl_lines(self, orders):
+        # Each order is followed by its line items, which point back to it through __parentId
+        for order in orders:
+            yield json.dumps({key: value for key, value in order.items() if key != "lineItems"})
+            for item in order["lineItems"]:
+                yield json.dumps(dict(item, __parentId=order["id"]))
+
+
+class FakeGmailServer:
+    """
+    Minimal Gmail API stand-in. Accepts POST /gmail/v1/users/<user>/drafts and
+    multipart/mixed batches on POST /batch/gmail/v1, and keeps every draft it
+    receives in `drafts`. `fail_every` answers every Nth draft with HTTP 400.
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.drafts = []
+        self.batch_count = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def create_draft(self, body):
+        """Returns (status, payload) for one drafts().create call."""
+        with self.lock:
+            draft_number = len(self.drafts) + 1
+            if self.fail_every and draft_number % self.fail_every == 0:
+                self.drafts.append(None)
+                return 400, {"error": {"code": 400, "message": "Invalid draft", "status": "INVALID_ARGUMENT"}}
+            self.drafts.append(body)
+        return 200, {"id": f"r-{draft_number}", "message": {"id": f"m-{draft_number}"}}
+
+    def handle_batch(self, content_type, body):
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+        response_boundary = f"batch_response_{boundary}"
+        response_parts = []
+
+        for part in body.split(f"--{boundary}".encode("utf-8"))[1:]:
+            if part.startswith(b"--"):
+                break
+            part_headers, _, http_request = part.strip(b"\r\n").partition(b"\r\n\r\n")
+            if not http_request:
+                part_headers, _, http_request = part.strip(b"\n").partition(b"\n\n")
+            content_id = re.search(rb"Content-ID: <([^>]+)>", part_headers, re.IGNORECASE).group(1).decode("utf-8")
+
+            # The inner request is a full HTTP message; only its JSON body matters here
+            request_body = re.split(rb"\r?\n\r?\n", http_request, maxsplit=1)[1]
+            status, payload = self.create_draft(json.loads(request_body))
+
+            reason = "OK" if status == 200 else "Bad Request"
+            response_parts.append(
+                f"--{response_boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {reason}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+
+        with self.lock:
+            self.batch_count += 1
+        return f"multipart/mixed; boundary={response_boundary}", ("".join(response_parts) + f"--{response_boundary}--\r\n").encode("utf-8")
+
+    def make_handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if fixture.latency:
+                    time.sleep(fixture.latency)
+
+                if self.path.startswith("/batch/gmail/v1"):
+                    content_type, payload = fixture.handle_batch(self.headers["Content-Type"], body)
+                    self.send(200, content_type, payload)
+                elif re.match(r"/gmail/v1/users/[^/]+/drafts", self.path):
+                    status, payload = fixture.create_draft(json.loads(body))
+                    self.send(status, "application/json", json.dumps(payload).encode("utf-8"))
+                else:
+                    self.send(404, "application/json", b'{"error": {"code": 404, "message": "Not Found"}}')
+
+            def send(self, status, content_type, payload):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve generated Shopify fulfillment orders locally.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--orders", type=int, default=50)
+    parser.add_argument("--items-per-order", type=int, default=3)
+    parser.add_argument("--long-order-every", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every GraphQL response")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth request with HTTP 429")
+    parser.add_argument("--maximum-available", type=float, default=1000.0, help="size of the query cost bucket")
+    parser.add_argument("--restore-rate", type=float, default=50.0, help="cost points restored per second")
+    parser.add_argument("--gmail-port", type=int, help="also serve a fake Gmail API on this port")
+    args = parser.parse_args()
+
+    server = FixtureServer(args.orders, args.items_per_order, args.long_order_every, port=args.port,
+                           maximum_available=args.maximum_available, restore_rate=args.restore_rate,
+                           latency=args.latency, throttle_every=args.throttle_every)
+    print(f"Serving {args.orders} fulfillment orders at {server.url}")
+
+    gmail_server = None
+    if args.gmail_port is not None:
+        gmail_server = FakeGmailServer(port=args.gmail_port)
+        gmail_server.start()
+        print(f"Serving a fake Gmail API at {gmail_server.url} (set GMAIL_API_ENDPOINT and GMAIL_OFFLINE=1)")
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+        if gmail_server is not None:
+            gmail_server.stop()
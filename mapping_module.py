@@ -0,0 +1,193 @@
+"""
+Shared helpers for turning fulfillment order nodes into vendor rows.
+
+VendorFormatter.map_vendor_data is the row-at-a-time (dict) engine. PageFrames
+and map_page_frames are the columnar engine: a page is normalized once into an
+order frame and a line item frame shared by every vendor at the location, and
+each vendor's rows are then a column selection, broadcast and rename. pandas
+is only imported when the columnar engine is used.
+"""
+from functools import lru_cache
+
+# Columns filled from the order's GIDs when the order has an id, overriding the mapping
+ORDER_ID_COLUMNS = ("PO Number", "id")
+CUSTOMER_ID_COLUMNS = ("Customer ID",)
+
+
+@lru_cache(maxsize=None)
+def compile_field_path(field_path):
+    """
+    Split a dotted mapping path into the keys used to walk a response node.
+    Numeric parts become list indexes, e.g. "order.lines.0.sku" -> ("order", "lines", 0, "sku").
+    """
+    return tuple(int(field) if field.isdigit() else field for field in field_path.split("."))
+
+
+def resolve_field_path(node, keys):
+    value = node
+    for key in keys:
+        if isinstance(key, int):  # Numeric index (indicating an array)
+            if isinstance(value, list) and 0 <= key < len(value):
+                value = value[key]
+            else:
+                return None
+        elif isinstance(value, dict) and key in value:
+            value = value[key]
+        else:
+            return None  # Handle missing fields gracefully
+
+    return value
+
+
+def resolve_column(nodes, keys):
+    """resolve_field_path for every node, with a faster walk when the path has no list indexes."""
+    if any(isinstance(key, int) for key in keys):
+        return [resolve_field_path(node, keys) for node in nodes]
+
+    values = []
+    for node in nodes:
+        value = node
+        try:
+            for key in keys:
+                value = value[key]
+        except (KeyError, TypeError):  # Missing key, or a None/list/string where a dict was expected
+            value = None
+        values.append(value)
+    return values
+
+
+def compile_vendor_plan(columns_order, mapping, default_values):
+    """
+    Turn a vendor's mapping and defaults into an execution plan, as plain
+    data so vendor_module can cache it on disk:
+      - row_template: defaults and static columns, copied for every order
+      - order_fields: [column, path] pairs resolved once per order
+      - line_item_fields: [column, field] pairs read from each line item
+      - order_paths / line_item_paths: the fields to request from Shopify
+    """
+    row_template = dict(default_values)
+    order_fields = []
+    line_item_fields = []
+    order_paths = set()
+    line_item_paths = set()
+
+    for column_name, details in mapping.items():
+        if details["level"] == "order":
+            order_fields.append([column_name, details["path"]])
+            order_paths.add(details["path"])
+        elif details["level"] == "line_item":
+            line_item_fields.append([column_name, details["path"]])
+            line_item_paths.add(details["path"])
+        elif details["level"] == "static":
+            row_template[column_name] = details["value"]
+
+    # The IDs extract_order_ids fills in are only fetched when a column uses them
+    if any(column_name in columns_order for column_name in ORDER_ID_COLUMNS):
+        order_paths.add("order.id")
+    if any(column_name in columns_order for column_name in CUSTOMER_ID_COLUMNS):
+        order_paths.add("order.customer.id")
+
+    return {
+        "columns_order": list(columns_order),
+        "row_template": row_template,
+        "order_fields": order_fields,
+        "line_item_fields": line_item_fields,
+        "order_paths": sorted(order_paths),
+        "line_item_paths": sorted(line_item_paths),
+    }
+
+
+def gid_to_id(gid):
+    # gid://shopify/Order/123 -> 123
+    return gid.split("/")[-1] if gid is not None else None
+
+
+class PageFrames:
+    """
+    One page of fulfillment orders normalized into two frames:
+      orders: one row per order, one column per order-level path
+      line_items: one row per line item that requires shipping, with an
+        "order_position" column pointing at its row in orders
+    Built once per page and shared by every vendor at the location.
+    """
+    def __init__(self, order_nodes, order_paths, line_item_paths):
+        import numpy as np
+        import pandas as pd
+
+        self.order_count = len(order_nodes)
+        order_paths = set(order_paths) | {"id", "order.id", "order.customer.id"}
+        self.orders = pd.DataFrame(
+            {path: pd.Series(resolve_column(order_nodes, compile_field_path(path)), dtype=object)
+             for path in sorted(order_paths)},
+            index=pd.RangeIndex(len(order_nodes)),
+        )
+        # Numeric IDs, or None for orders without one
+        self.order_ids = self.orders["order.id"].map(gid_to_id, na_action="ignore").to_numpy(dtype=object)
+        self.customer_ids = self.orders["order.customer.id"].map(gid_to_id, na_action="ignore").to_numpy(dtype=object)
+
+        # Explode every order's line item list into one row per line item, keeping the order's position
+        line_item_lists = pd.Series([node.get("lineItems", {}).get("nodes", []) for node in order_nodes], dtype=object)
+        exploded = line_item_lists.explode().dropna()
+        line_items = pd.DataFrame(exploded.tolist(), dtype=object, index=pd.RangeIndex(len(exploded)))
+
+        columns = {"order_position": exploded.index.to_numpy()}
+        for path in sorted(line_item_paths):
+            if path in line_items:
+                # Keys some line items lack come out as NaN; the dict engine gives None for them
+                values = line_items[path].to_numpy(dtype=object, copy=True)
+                values[pd.isna(values)] = None
+            else:
+                values = [None] * len(line_items)
+            # object dtype so newer pandas doesn't infer a string column and turn None back into NaN
+            columns[path] = pd.Series(values, dtype=object, index=pd.RangeIndex(len(line_items)))
+        self.line_items = pd.DataFrame(columns, index=pd.RangeIndex(len(line_items)))
+
+        # Digital items are dropped for every vendor at once. Read from the nodes rather than the frame,
+        # which can't tell a missing requiresShipping (shipped) from an explicit null (not), the same
+        # as map_vendor_data's line_item_node.get("requiresShipping", True)
+        if len(line_items):
+            requires_shipping = np.fromiter((bool(item.get("requiresShipping", True)) for item in exploded),
+                                            dtype=bool, count=len(exploded))
+            self.line_items = self.line_items[requires_shipping].reset_index(drop=True)
+
+
+def map_page_frames(frames, columns_order, row_template, order_accessors, line_item_accessors, keep_order_ids=None):
+    """
+    Columnar equivalent of VendorFormatter.map_vendor_data for a whole page.
+    order_accessors are (column, path) pairs, line_item_accessors (column, field)
+    pairs. keep_order_ids limits the output to those fulfillment order ids.
+    Returns a DataFrame with columns_order as its columns and plain Python values.
+    """
+    import numpy as np
+    import pandas as pd
+
+    line_items = frames.line_items
+    if keep_order_ids is not None:
+        keep_positions = np.flatnonzero(frames.orders["id"].isin(keep_order_ids).to_numpy())
+        line_items = line_items[line_items["order_position"].isin(keep_positions)]
+
+    positions = line_items["order_position"].to_numpy(dtype=np.intp)
+    row_count = len(positions)
+
+    def broadcast(value):
+        column = np.empty(row_count, dtype=object)
+        column[:] = [value] * row_count if isinstance(value, (list, dict)) else value
+        return column
+
+    # Same precedence as map_vendor_data: defaults/statics, then order values, line item values and order IDs
+    columns = {column: broadcast(value) for column, value in row_template.items()}
+    for column, path in order_accessors:
+        columns[column] = frames.orders[path].to_numpy(dtype=object)[positions]
+    for column, field in line_item_accessors:
+        columns[column] = line_items[field].to_numpy(dtype=object)
+
+    for id_columns, ids in ((ORDER_ID_COLUMNS, frames.order_ids), (CUSTOMER_ID_COLUMNS, frames.customer_ids)):
+        row_ids = ids[positions]
+        has_id = pd.notna(row_ids)
+        if has_id.any():
+            for column in id_columns:
+                existing = columns.get(column, broadcast(None))
+                columns[column] = np.where(has_id, row_ids, existing)
+
+    return pd.DataFrame({column: columns.get(column, broadcast(None)) for column in columns_order},
+                        columns=columns_order, dtype=object)
@@ -0,0 +1,226 @@
+"""
+Run instrumentation: per-stage timings and counters, grouped by scope.
+
+A scope is usually a vendor name; GraphQL requests are shared by every vendor
+at a location, so they are grouped as "location <id>", and Gmail auth/batches
+under "gmail". The module-level `metrics` collects one run and can be written
+as a JSON report or as a Prometheus text file for node_exporter's textfile
+collector. A resident process takes each cycle's scopes out with take(), which
+leaves the Prometheus totals whole.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+PROMETHEUS_PREFIX = "order_processing"
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        # (scope, stage) -> [calls, total seconds, max seconds]
+        self.stages = {}
+        # (scope, name) -> running total
+        self.counters = {}
+        # (scope, name) -> last value seen
+        self.gauges = {}
+        # What take() has already handed out, still part of the Prometheus totals
+        self.taken_stages = {}
+        self.taken_counters = {}
+        self.taken_gauges = {}
+
+    def observe(self, stage, seconds, scope=""):
+        with self.lock:
+            stage_totals = self.stages.setdefault((scope, stage), [0, 0.0, 0.0])
+            stage_totals[0] += 1
+            stage_totals[1] += seconds
+            stage_totals[2] = max(stage_totals[2], seconds)
+
+    @contextmanager
+    def timer(self, stage, scope=""):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time, scope)
+
+    def increment(self, name, value=1, scope=""):
+        with self.lock:
+            self.counters[(scope, name)] = self.counters.get((scope, name), 0) + value
+
+    def set_gauge(self, name, value, scope=""):
+        with self.lock:
+            self.gauges[(scope, name)] = value
+
+    def report(self):
+        """Everything collected so far as {"scopes": {scope: {"stages", "counters", "gauges"}}}."""
+        with self.lock:
+            return build_report(self.stages, self.counters, self.gauges, self.started_at)
+
+    def take(self, scopes, started_at=None):
+        """
+        Report only these scopes, e.g. one serve cycle's location and vendors,
+        and start them over. Cycles for other locations use other scopes, so
+        they can be running at the same time.
+        """
+        scopes = set(scopes)
+        with self.lock:
+            taken = []
+            for kind, data, taken_data in (("stages", self.stages, self.taken_stages),
+                                           ("counters", self.counters, self.taken_counters),
+                                           ("gauges", self.gauges, self.taken_gauges)):
+                taken.append({key: data.pop(key) for key in [key for key in data if key[0] in scopes]})
+                merge_metrics(taken_data, taken[-1], kind)
+        return build_report(*taken, started_at or self.started_at)
+
+    def totals(self):
+        # Everything since the process started, taken or not
+        with self.lock:
+            stages, counters, gauges = dict(self.taken_stages), dict(self.taken_counters), dict(self.taken_gauges)
+            merge_metrics(stages, self.stages, "stages")
+            merge_metrics(counters, self.counters, "counters")
+            merge_metrics(gauges, self.gauges, "gauges")
+        return stages, counters, gauges
+
+    def write_json(self, path, extra=None, report=None):
+        report = dict(report or self.report())
+        report.update(extra or {})
+        write_atomically(path, json.dumps(report, indent=2, default=str))
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics in Prometheus text format. The file is replaced in one
+        rename so the textfile collector never reads half of it.
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            if not samples:
+                return
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels)
+                label_text = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{label_text} {value}")
+
+        stages, counters, gauges = (sorted(data.items()) for data in self.totals())
+
+        metric("stage_seconds_total", "counter", "Time spent in each pipeline stage.",
+               [((("scope", scope), ("stage", stage)), seconds) for (scope, stage), (calls, seconds, max_seconds) in stages])
+        metric("stage_calls_total", "counter", "Times each pipeline stage ran.",
+               [((("scope", scope), ("stage", stage)), calls) for (scope, stage), (calls, seconds, max_seconds) in stages])
+        metric("stage_max_seconds", "gauge", "Slowest single run of each pipeline stage.",
+               [((("scope", scope), ("stage", stage)), max_seconds) for (scope, stage), (calls, seconds, max_seconds) in stages])
+
+        for name in sorted({name for (scope, name), value in counters}):
+            metric(f"{metric_name(name)}_total", "counter", f"{name} counted during the run.",
+                   [((("scope", scope),), value) for (scope, counter_name), value in counters if counter_name == name])
+        for name in sorted({name for (scope, name), value in gauges}):
+            metric(metric_name(name), "gauge", f"Last {name} seen during the run.",
+                   [((("scope", scope),), value) for (scope, gauge_name), value in gauges if gauge_name == name])
+
+        metric("last_run_timestamp_seconds", "gauge", "When the run finished.", [((), round(time.time(), 3))])
+        write_atomically(path, "\n".join(lines) + "\n")
+
+
+def build_report(stages, counters, gauges, started_at):
+    scopes = {}
+    for (scope, stage), (calls, seconds, max_seconds) in sorted(stages.items()):
+        scopes.setdefault(scope, {"stages": {}, "counters": {}, "gauges": {}})["stages"][stage] = {
+            "calls": calls, "seconds": round(seconds, 4), "max_seconds": round(max_seconds, 4)}
+    for (scope, name), value in sorted(counters.items()):
+        scopes.setdefault(scope, {"stages": {}, "counters": {}, "gauges": {}})["counters"][name] = value
+    for (scope, name), value in sorted(gauges.items()):
+        scopes.setdefault(scope, {"stages": {}, "counters": {}, "gauges": {}})["gauges"][name] = value
+
+    return {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started_at)),
+        "seconds": round(time.time() - started_at, 3),
+        "scopes": scopes,
+    }
+
+
+def merge_metrics(into, data, kind):
+    # Stages add up and keep the larger max, counters add up, gauges keep the newer value
+    for key, value in data.items():
+        if kind == "stages":
+            calls, seconds, max_seconds = into.get(key, (0, 0.0, 0.0))
+            into[key] = [calls + value[0], seconds + value[1], max(max_seconds, value[2])]
+        elif kind == "counters":
+            into[key] = into.get(key, 0) + value
+        else:
+            into[key] = value
+
+
+def metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def write_atomically(path, text):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "w") as file:
+            file.write(text)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+class Profiler:
+    """
+    Optional deeper digging around a whole run, PROFILE=cprofile or PROFILE=tracemalloc.
+    cProfile stats are saved to <output_path>.prof and the top functions printed
+    (Python 3.12+ profiles the worker threads too, older versions only the main
+    thread); tracemalloc prints the peak and the lines that allocated the most.
+    """
+    def __init__(self, mode, output_path="profile"):
+        if mode not in ("", "cprofile", "tracemalloc"):
+            raise ValueError(f"Unknown PROFILE mode {mode!r}, expected cprofile or tracemalloc")
+        self.mode = mode
+        self.output_path = output_path
+        self.profile = None
+
+    def __enter__(self):
+        if self.mode == "cprofile":
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.mode == "tracemalloc":
+            import tracemalloc
+            tracemalloc.start(10)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.mode == "cprofile":
+            import pstats
+            self.profile.disable()
+            # The day's output folder only exists once a file has been written there
+            os.makedirs(os.path.dirname(self.output_path) or ".", exist_ok=True)
+            self.profile.dump_stats(f"{self.output_path}.prof")
+            print(f"\ncProfile stats saved to {self.output_path}.prof")
+            pstats.Stats(self.profile).sort_stats("cumulative").print_stats(25)
+        elif self.mode == "tracemalloc":
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"\nPeak traced memory: {peak / 1024 / 1024:.1f} MiB, largest allocations still held:")
+            for statistic in snapshot.statistics("lineno")[:15]:
+                print(f"  {statistic}")
+
+
+# One collector per process, shared by every thread
+metrics = RunMetrics()
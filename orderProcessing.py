@@ -1,418 +1,709 @@
-import requests
-import pandas as pd
+import argparse
 import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from openpyxl import load_workbook
-from openpyxl.utils import get_column_letter
 from datetime import datetime
-from email_module import create_and_draft_email
+from metrics_module import Profiler, metrics
+from mapping_module import (PageFrames, compile_field_path, compile_vendor_plan, gid_to_id, map_page_frames,
+                            resolve_field_path)
+from shopify_module import (FulfillmentOrderPager, build_bulk_query, build_fulfillment_orders_query, find_end_cursor,
+                            find_next_order_id, get_transport, prefetch, run_bulk_query, stream_bulk_results)
+from state_module import StateStore
+from vendor_module import VendorConfigError, load_vendors
+from writer_module import OUTPUT_FORMATS, missing_dependency_message, open_writer
 
-current_date = datetime.now()
-# Create date format for orders
-year = current_date.strftime('%Y')
-month_number = current_date.strftime('%m')
-month_name = current_date.strftime('%B')
-day = current_date.strftime('%d')
 
-path_prefix = f'./{year}/{month_number} - {month_name}/{month_number}-{day}-{year}/'
+# Vendor definitions ship next to this file; VENDOR_DIR points somewhere else
+DEFAULT_VENDOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendors")
+
+
+def output_path_prefix(run_date):
+    # e.g. ./2024/03 - March/03-15-2024/
+    return run_date.strftime('./%Y/%m - %B/%m-%d-%Y/')
+
+
+# Fields every query needs whatever the vendors map: the fulfillment order id (for dedup and
+# line item follow-ups) and requiresShipping (to skip digital items)
+required_order_paths = ("id",)
+required_line_item_paths = ("requiresShipping",)
 
 
 class VendorFormatter:
-    def __init__(self, location_id, output_filename):
+    def __init__(self, location_id, output_filename, vendor_name=None):
         self.location_id = location_id
         self.output_filename = output_filename
+        self.vendor_name = vendor_name or output_filename
         self.columns_order = []
         self.mapping = {}
         self.default_values = {}
-        self.location_id_file = f"lastRun_{location_id}.txt"
-        
+        self.flattened_data = []
+        # DataFrames from the columnar engine, written after flattened_data
+        self.frames = []
+        self.state_store = None
+        # Fulfillment orders mapped this run, recorded in the state store once the file is written
+        self.exported_order_ids = []
+        # Emailed format, and an optional copy kept for ourselves, see writer_module.OUTPUT_FORMATS
+        self.output_format = "xlsx"
+        self.archive_format = None
+        self.max_rows_per_file = None
+        self.max_bytes_per_file = None
+        self.compile_mapping()
 
     def set_defaults(self, default_values):
         if default_values is not None:
             self.default_values = default_values
         else:
             self.default_values = {}
+        self.compile_mapping()
+
+    def set_state_store(self, state_store):
+        self.state_store = state_store
+
+    def set_output(self, output_format="xlsx", archive_format=None, max_rows_per_file=None, max_bytes_per_file=None):
+        # Checked here so a typo fails before anything is downloaded
+        for file_format in (output_format, archive_format):
+            if file_format is not None and file_format not in OUTPUT_FORMATS:
+                raise ValueError(f"Unknown output format {file_format!r} for {self.vendor_name}, "
+                                 f"expected one of {', '.join(OUTPUT_FORMATS)}")
+            if file_format is not None and missing_dependency_message(file_format):
+                raise RuntimeError(f"{missing_dependency_message(file_format)}, used by {self.vendor_name}")
+        self.output_format = output_format
+        self.archive_format = archive_format
+        self.max_rows_per_file = max_rows_per_file
+        self.max_bytes_per_file = max_bytes_per_file
+
+    def reset(self):
+        # Drop the previous cycle's rows but keep the compiled mapping, for the resident service
+        self.flattened_data = []
+        self.frames = []
+        self.exported_order_ids = []
 
     def set_mapping(self, columns_order, mapping):
         self.columns_order = columns_order
         self.mapping = mapping
+        self.compile_mapping()
+
+    def compile_mapping(self):
+        """
+        Turn the mapping and defaults into an execution plan so map_vendor_data
+        doesn't have to re-read the mapping for every line item, see
+        mapping_module.compile_vendor_plan.
+        """
+        self.set_plan(compile_vendor_plan(self.columns_order, self.mapping, self.default_values))
+
+    def set_plan(self, plan):
+        """
+        Use a compiled plan, e.g. one vendor_module loaded from its cache:
+          - row_template: defaults and static columns, copied for every order
+          - order_accessors: (column, keys) pairs resolved once per order
+          - order_fields: the same as (column, path) pairs, for the columnar engine
+          - line_item_accessors: (column, field) pairs read from each line item
+          - order_paths / line_item_paths: the fields to request from Shopify
+        """
+        self.columns_order = plan["columns_order"]
+        self.row_template = plan["row_template"]
+        self.order_fields = [(column_name, path) for column_name, path in plan["order_fields"]]
+        self.order_accessors = [(column_name, compile_field_path(path)) for column_name, path in self.order_fields]
+        self.line_item_accessors = [(column_name, field) for column_name, field in plan["line_item_fields"]]
+
+        # GraphQL fields this vendor needs, see LocationFetcher.build_queries
+        self.order_paths = frozenset(plan["order_paths"])
+        self.line_item_paths = frozenset(plan["line_item_paths"])
 
     def extract_nested_field(self, node, field_path):
         """
         Extract a nested field from the GraphQL response node.
         Example: extract_nested_field(order_node, "shippingAddress.name")
         """
-        fields = field_path.split(".")
-        value = node
-        for field in fields:
-            if field.isdigit():  # Check if the field is a numeric index (indicating an array)
-                field = int(field)
-                if isinstance(value, list) and 0 <= field < len(value):
-                    value = value[field]
-                else:
-                    return None
-            elif field in value:
-                value = value[field]
-            else:
-                return None  # Handle missing fields gracefully
-            
-        return value
+        return resolve_field_path(node, compile_field_path(field_path))
+
+    def extract_order_ids(self, order_node):
+        # Numeric IDs taken from the order's GIDs, e.g. gid://shopify/Order/123 -> 123
+        order_ids = {}
+        order_data = order_node.get("order")
+        if isinstance(order_data, dict):
+            if order_data.get("id") is not None:
+                order_ids["PO Number"] = order_ids["id"] = gid_to_id(order_data["id"])
+
+            customer = order_data.get("customer")
+            if isinstance(customer, dict) and customer.get("id") is not None:
+                order_ids["Customer ID"] = gid_to_id(customer["id"])
+
+        return order_ids
 
     def map_vendor_data(self, order_node):
         all_line_items_data = []
-
-        for line_item_node in order_node.get("lineItems", {}).get("nodes", []):
+        line_item_nodes = order_node.get("lineItems", {}).get("nodes", [])
+        if not line_item_nodes:
+            return all_line_items_data
+
+        # Everything that doesn't depend on the line item is resolved once per order
+        order_row = self.row_template.copy()
+        for column_name, keys in self.order_accessors:
+            order_row[column_name] = resolve_field_path(order_node, keys)
+
+        line_item_accessors = self.line_item_accessors
+        order_ids = self.extract_order_ids(order_node)
+        if order_ids:
+            order_row.update(order_ids)
+            # The order IDs win over a line item column of the same name
+            if any(column_name in order_ids for column_name, field in line_item_accessors):
+                line_item_accessors = [(column_name, field) for column_name, field in line_item_accessors
+                                       if column_name not in order_ids]
+
+        for line_item_node in line_item_nodes:
             if line_item_node.get("requiresShipping", True):
-                vendor_data = {}
-                for column_name, details in self.mapping.items():
-                    if details["level"] == "order":
-                        vendor_data[column_name] = self.extract_nested_field(order_node, details["path"])
-                    elif details["level"] == "line_item":
-                        vendor_data[column_name] = line_item_node.get(details["path"])
-                    elif details["level"] == "static":
-                        vendor_data[column_name] = details["value"]
-
-                if "order" in order_node:
-                    order_data = order_node["order"]
-                    if "id" in order_data:
-                        vendor_data["PO Number"] = order_data["id"].split("/")[-1]
-                        vendor_data["id"] = order_data["id"].split("/")[-1]
-
-                    if "customer" in order_data and "id" in order_data["customer"]:
-                        vendor_data["Customer ID"] = order_data["customer"]["id"].split("/")[-1]
-
-                # Set default values for columns that need them
-                for column_name, default_value in self.default_values.items():
-                    vendor_data.setdefault(column_name, default_value)
+                vendor_data = order_row.copy()
+                for column_name, field in line_item_accessors:
+                    vendor_data[column_name] = line_item_node.get(field)
 
                 all_line_items_data.append(vendor_data)
 
         return all_line_items_data
 
+    def new_order_nodes(self, order_nodes):
+        # Skip fulfillment orders this vendor has already been sent before doing any mapping
+        if self.state_store is not None:
+            already_exported = self.state_store.exported_ids(
+                self.vendor_name, [order_node["id"] for order_node in order_nodes if "id" in order_node])
+            if already_exported:
+                order_nodes = [order_node for order_node in order_nodes if order_node.get("id") not in already_exported]
+                metrics.increment("orders_already_exported", len(already_exported), scope=self.vendor_name)
+            self.exported_order_ids.extend(order_node["id"] for order_node in order_nodes if "id" in order_node)
+        return order_nodes
+
+    def process_orders(self, order_nodes):
+        # Map one page of fulfillment orders and keep the rows for this vendor's file
+        with metrics.timer("map", self.vendor_name):
+            order_nodes = self.new_order_nodes(order_nodes)
+            rows_before = len(self.flattened_data)
+            for order_node in order_nodes:
+                line_items_data = self.map_vendor_data(order_node)
+                self.flattened_data.extend(line_items_data)
+        self.record_mapped(order_nodes, len(self.flattened_data) - rows_before)
+
+    def record_mapped(self, order_nodes, rows_out):
+        # Line items that didn't become rows were skipped for not requiring shipping
+        line_items = sum(len(order_node.get("lineItems", {}).get("nodes", [])) for order_node in order_nodes)
+        metrics.increment("orders_in", len(order_nodes), scope=self.vendor_name)
+        metrics.increment("rows_out", rows_out, scope=self.vendor_name)
+        metrics.increment("rows_skipped_requires_shipping", line_items - rows_out, scope=self.vendor_name)
+
+    def process_frames(self, page_frames, order_nodes):
+        # Columnar engine: select this vendor's columns from the page's shared frames
+        with metrics.timer("map", self.vendor_name):
+            new_order_nodes = self.new_order_nodes(order_nodes)
+            keep_order_ids = None
+            if len(new_order_nodes) < len(order_nodes):
+                keep_order_ids = {order_node.get("id") for order_node in new_order_nodes}
+
+            frame = map_page_frames(page_frames, self.columns_order, self.row_template, self.order_fields,
+                                    self.line_item_accessors, keep_order_ids)
+            if len(frame):
+                self.frames.append(frame)
+        self.record_mapped(new_order_nodes, len(frame))
+
+    def row_count(self):
+        return len(self.flattened_data) + sum(len(frame) for frame in self.frames)
+
+    def write_output(self, path_prefix=None, file_suffix=""):
+        """
+        Write the rows in output_format, split into parts past the row or byte
+        limits, plus an archive copy in archive_format when one is set.
+        Returns the paths to email, which is empty when there was no data.
+        """
+        if path_prefix is None:
+            path_prefix = output_path_prefix(datetime.now())
 
+        if not (self.flattened_data or self.frames):
+            print("No data to include in the DataFrame.")
+            return []
+
+        file_stem = f"{path_prefix}{self.output_filename}{file_suffix}"
+        # (format, max rows, max bytes), the emailed one first
+        file_formats = [(self.output_format, self.max_rows_per_file, self.max_bytes_per_file)]
+        if self.archive_format and self.archive_format != self.output_format:
+            file_formats.append((self.archive_format, None, None))
+
+        writers = []
+        # Rows are streamed into each file; workbook column widths are worked out as they go
+        with metrics.timer("write", self.vendor_name):
+            for file_format, max_rows, max_bytes in file_formats:
+                with open_writer(file_format, file_stem, self.columns_order, max_rows, max_bytes) as writer:
+                    writer.write_dicts(self.flattened_data)
+                    for frame in self.frames:
+                        writer.write_rows(frame.itertuples(index=False, name=None))
+                writers.append(writer)
+
+        for writer in writers:
+            metrics.increment("files_written", len(writer.paths), scope=self.vendor_name)
+            metrics.increment("file_bytes", sum(os.path.getsize(path) for path in writer.paths), scope=self.vendor_name)
+        metrics.increment("rows_written", writers[0].row_count, scope=self.vendor_name)
+        return writers[0].paths
 
-
-    
     def run_query_and_format(self):
-        # Your Shopify GraphQL endpoint
-        graphql_endpoint = os.getenv("ENDPOINT_URL")
-
-        # Your Shopify access token
-        access_token = os.getenv("ACCESS_TOKEN")
-
-        # GraphQL query template with a variable
-        graphql_query_template = """
-            query FulfillmentOrders($locationId: String!, $after: String) {
-                fulfillmentOrders(
-                    first: 5
-                    query: $locationId
-                    includeClosed: true
-                    after: $after
-                ) {
-                    nodes {
-                        assignedLocation {
-                            name
-                        }
-                        order {
-                            id
-                            name
-                            billingAddress {
-                                address1
-                                address2
-                                company
-                                city
-                                countryCode
-                                firstName
-                                lastName
-                                name
-                                phone
-                                provinceCode
-                                zip
-                            }
-                            customer {
-                                id
-                                email
-                            }
-                            shippingAddress {
-                                address1
-                                address2
-                                company
-                                city
-                                countryCode
-                                firstName
-                                lastName
-                                name
-                                phone
-                                provinceCode
-                                zip
-                            }
-                            shippingLine {
-                                title
-                            }
-                        }
-                        status
-                        lineItems(first: 25) {
-                            pageInfo {
-                                hasNextPage
-                            }
-                            edges {
-                                cursor
-                            }
-                            nodes {
-                                sku
-                                totalQuantity
-                                productTitle
-                                requiresShipping
-                            }
-                        }
-                        createdAt
-                    }
-                    pageInfo {
-                        endCursor
-                        hasNextPage
-                    }
-                    edges {
-                        cursor
-                    }
-                }
-            }
+        # Run this vendor on its own; use plan_location_fetches to share a download between vendors
+        cursor = load_cursor(self.state_store, self.vendor_name, self.location_id)
+        location_fetcher = LocationFetcher(self.location_id, cursor, state_store=self.state_store)
+        location_fetcher.add_formatter(self)
+        location_fetcher.run_query_and_format()
+
+
+def load_cursor(state_store, vendor_name, location_id):
+    """
+    The cursor a vendor last exported up to at this location. Falls back to the
+    old per-location lastRun_{location_id}.txt file for vendors the state store
+    hasn't seen yet.
+    """
+    if state_store is not None and state_store.has_cursor(vendor_name, location_id):
+        return state_store.get_cursor(vendor_name, location_id)
+
+    location_id_file = f"lastRun_{location_id}.txt"
+    if os.path.isfile(location_id_file):
+        with open(location_id_file, "r") as file:
+            return file.read().strip() or None
+    return None
+
+
+class LocationFetcher:
+    """
+    Downloads a location's fulfillment orders once, starting from a saved
+    cursor, and hands every page to each vendor formatter that shares it.
+    """
+    def __init__(self, location_id, cursor=None, bulk=False, state_store=None, prefetch_pages=2, engine="dict"):
+        self.location_id = location_id
+        self.start_cursor = cursor
+        # Last cursor reached; only saved for a vendor once its file has been written
+        self.end_cursor = cursor
+        # Export through a Shopify bulk operation instead of paging, for large catch-up runs
+        self.bulk = bulk
+        self.state_store = state_store
+        # Pages downloaded ahead while the current one is being mapped
+        self.prefetch_pages = prefetch_pages
+        # "dict" maps row by row, "columnar" maps whole pages with pandas
+        self.engine = engine
+        self.formatters = []
+        self.vendors = []
+
+    def add_formatter(self, formatter, vendor_details=None):
+        self.formatters.append(formatter)
+        self.vendors.append((vendor_details, formatter))
+
+    def build_queries(self):
         """
-
-        all_flattened_data = []
-        cursor = None
-
-        while True:
-            if os.path.isfile(self.location_id_file):
-                with open(self.location_id_file, "r") as file:
-                    cursor = file.read().strip()
-
-            response = requests.post(
-                graphql_endpoint,
-                json={"query": graphql_query_template, "variables": {"locationId": f"assigned_location_id:{self.location_id}", "after": cursor}},
-                headers={"Content-Type": "application/json", "X-Shopify-Access-Token": access_token},
-            )
-            data = response.json()
-
-            for order_node in data["data"]["fulfillmentOrders"]["nodes"]:
-                line_items_data = self.map_vendor_data(order_node)
-                all_flattened_data.extend(line_items_data)
-
-            # Update cursor for the next page
-            has_next_page = data["data"]["fulfillmentOrders"]["pageInfo"]["hasNextPage"]
-            cursor = data["data"]["fulfillmentOrders"]["pageInfo"]["endCursor"]
-            if has_next_page:                
-                with open(self.location_id_file, "w") as file:
-                    file.write(cursor)
-            else:
-                break
-
-        if cursor is not None:
-            with open(self.location_id_file, "w") as file:
-                file.write(cursor)
-
-        if all_flattened_data:
-            df = pd.DataFrame(all_flattened_data, columns=self.columns_order)
-            xlsx_file_path = f"{path_prefix}{self.output_filename}.xlsx"
-
-            # Create directory structure if it doesn't already exist
-            os.makedirs(os.path.dirname(xlsx_file_path), exist_ok=True)
-
-            df.to_excel(xlsx_file_path, index=False)
-
-            # Auto-adjust columns' width
-            workbook = load_workbook(xlsx_file_path)
-            worksheet = workbook.active
-
-            for column_cells in worksheet.columns:
-                length = max(len(str(cell.value)) for cell in column_cells) + 2
-                worksheet.column_dimensions[get_column_letter(column_cells[0].column)].width = length
-
-            workbook.save(xlsx_file_path)
-            #print(f"XLSX file has been created: {xlsx_file_path}")
+        Queries selecting only the fields this location's vendors map.
+        Returns (page query, fulfillment order selection, line item selection).
+        """
+        order_paths = frozenset(required_order_paths).union(*(f.order_paths for f in self.formatters))
+        line_item_paths = frozenset(required_line_item_paths).union(*(f.line_item_paths for f in self.formatters))
+        return build_fulfillment_orders_query(order_paths, line_item_paths)
+
+    def distribute(self, order_nodes):
+        # Fan the page out to every vendor sharing this location
+        if self.engine == "columnar":
+            page_frames = PageFrames(order_nodes,
+                                     frozenset().union(*(f.order_paths for f in self.formatters)),
+                                     frozenset().union(*(f.line_item_paths for f in self.formatters)))
+            for formatter in self.formatters:
+                formatter.process_frames(page_frames, order_nodes)
         else:
-            print("No data to include in the DataFrame.")
-
+            for formatter in self.formatters:
+                formatter.process_orders(order_nodes)
+
+    def fetch_orders(self):
+        if self.bulk:
+            self.fetch_orders_bulk()
+            return
+
+        query, fulfillment_order_fields, line_item_fields = self.build_queries()
+        pager = FulfillmentOrderPager(self.location_id, query, line_item_fields)
+        for order_nodes, end_cursor, has_next_page in prefetch(pager.pages(self.start_cursor), self.prefetch_pages):
+            self.distribute(order_nodes)
+
+            if end_cursor is not None:
+                self.end_cursor = end_cursor
+
+    def fetch_orders_bulk(self):
+        # Bulk queries take no cursor, so a saved cursor becomes an id filter starting at the first
+        # order after it (orders page in id order). Without a cursor it's the whole history, as on
+        # a first paged run.
+        minimum_id = None
+        if self.start_cursor is not None:
+            next_order_id = find_next_order_id(self.location_id, self.start_cursor)
+            if next_order_id is None:
+                # Nothing new since the cursor
+                return
+            minimum_id = gid_to_id(next_order_id)
+
+        # Bulk results have no page cursor either, so walk to the last one first and save that,
+        # letting the next paged run resume after the export. Orders created in between are in
+        # both, and the second time they're skipped as already exported.
+        end_cursor = find_end_cursor(self.location_id, self.start_cursor)
+        query, fulfillment_order_fields, line_item_fields = self.build_queries()
+        bulk_query = build_bulk_query(self.location_id, fulfillment_order_fields, line_item_fields, minimum_id)
+        for order_nodes in prefetch(stream_bulk_results(run_bulk_query(bulk_query)), self.prefetch_pages):
+            self.distribute(order_nodes)
+        self.end_cursor = end_cursor
+
+    def commit_vendor(self, formatter):
+        # Save where this vendor got to, together with the orders it was sent
+        if self.state_store is not None:
+            self.state_store.commit_vendor(formatter.vendor_name, self.location_id, self.end_cursor,
+                                           formatter.exported_order_ids)
 
+    def run_query_and_format(self):
+        self.fetch_orders()
+        for formatter in self.formatters:
+            formatter.write_output()
+            self.commit_vendor(formatter)
+
+
+def build_vendor_formatter(vendor_details, state_store=None):
+    vendor_formatter = VendorFormatter(vendor_details["location_id"], vendor_details["output_filename"],
+                                       vendor_details["vendor_name"])
+    if "plan" in vendor_details:
+        # Already compiled by vendor_module.load_vendors, or taken from its cache
+        vendor_formatter.mapping = vendor_details["mapping"]
+        vendor_formatter.default_values = vendor_details.get("defaults", {})
+        vendor_formatter.set_plan(vendor_details["plan"])
+    else:
+        vendor_formatter.set_mapping(vendor_details["columns_order"], vendor_details["mapping"])
+        vendor_formatter.set_defaults(vendor_details.get("defaults",{}))
+    vendor_formatter.set_state_store(state_store)
+    vendor_formatter.set_output(vendor_details.get("output_format", "xlsx"), vendor_details.get("archive_format"),
+                                vendor_details.get("max_rows_per_file"), vendor_details.get("max_bytes_per_file"))
+    return vendor_formatter
+
+
+def plan_location_fetches(vendors, state_store=None, bulk=False, prefetch_pages=2, engine="dict", formatters=None):
+    """
+    Group vendors by location_id and saved cursor so each location is only
+    paginated once (vendors that were last exported up to different cursors
+    need their own fetch). Returns one LocationFetcher per group, in the order
+    the groups first appear.
+    formatters ({vendor_name: VendorFormatter}) reuses already compiled
+    formatters instead of building new ones.
+    """
+    location_fetchers = {}
+    for vendor_details in vendors:
+        location_id = vendor_details["location_id"]
+        cursor = load_cursor(state_store, vendor_details["vendor_name"], location_id)
+        if (location_id, cursor) not in location_fetchers:
+            location_fetchers[(location_id, cursor)] = LocationFetcher(location_id, cursor, bulk, state_store,
+                                                                         prefetch_pages, engine)
+
+        if formatters is not None and vendor_details["vendor_name"] in formatters:
+            vendor_formatter = formatters[vendor_details["vendor_name"]]
+            vendor_formatter.reset()
+        else:
+            vendor_formatter = build_vendor_formatter(vendor_details, state_store)
+        location_fetchers[(location_id, cursor)].add_formatter(vendor_formatter, vendor_details)
 
+    return list(location_fetchers.values())
 
-# Load environment variables from .env
-load_dotenv()
-
-# List of vendors with their formatting details
-vendors = [
-    {
-        "location_id": "00000000000",
-        "vendor_name": "vendor1",
-        "output_filename": "filename1",
-        "email_addresses": [
-            "example@example.com",
-        ],
-        "columns_order": ["Order ID", "Ship-to Name", "Ship-to Address 1", "Ship-to Address 2", "Ship-to City",
-                          "Ship-to State", "Ship-to Zip", "", "SKU Number", "Quantity"],
-        "mapping": {
-            "Order ID": {"path": "order.name", "level": "order"},
-            "Ship-to Name":  {"path": "order.shippingAddress.name", "level": "order"},
-            "Ship-to Address 1":  {"path": "order.shippingAddress.address1", "level": "order"},
-            "Ship-to Address 2":  {"path": "order.shippingAddress.address2", "level": "order"},
-            "Ship-to City":  {"path": "order.shippingAddress.city", "level": "order"},
-            "Ship-to State":  {"path": "order.shippingAddress.provinceCode", "level": "order"},
-            "Ship-to Zip":  {"path": "order.shippingAddress.zip", "level": "order"},
-            "": {"path": "static", "level": "static", "value": "Home"},
-            "SKU Number":  {"path": "sku", "level": "line_item"},
-            "Quantity":  {"path": "totalQuantity", "level": "line_item"},
-        },
-        "defaults": {
-            "": "Home"
-        }
-    },
-    {
-        "location_id":"00000000000",
-        "vendor_name": "vendor2",
-        "output_filename": "filename2",
-        "email_addresses": [
-            "example@example.com"
-        ],
-        "columns_order": ["Name", "Email", "Created At", "Shipping Method", "Lineitem quantity",
-            "Lineitem Name", "Lineitem sku", "Billing Name", "Billing Address1", "Billing Address2",
-            "Billing Company", "Billing City", "Billing Zip", "Billing Province", "Billing Country",
-            "Billing Phone", "Shipping Name", "Shipping Address1", "Shipping Address2", "Shipping Company",
-            "Shipping City", "Shipping Zip", "Shipping Province", "Shipping Country", "Shipping Phone", "Id"],
-        "mapping": {
-            "Name": {"path": "order.name", "level": "order"},
-            "Email": {"path": "order.customer.email", "level": "order"},
-            "Created At": {"path": "createdAt", "level": "order"},
-            "Shipping Method": {"path": "order.shippingLine.title", "level": "order"},
-            "Lineitem quantity": {"path": "totalQuantity", "level": "line_item"},
-            "Lineitem Name": {"path": "productTitle", "level": "line_item"},
-            "Lineitem sku": {"path": "sku", "level": "line_item"},
-            "Billing Name": {"path": "order.billingAddress.name", "level": "order"},
-            "Billing Address1": {"path": "order.billingAddress.address1", "level": "order"},
-            "Billing Address2": {"path": "order.billingAddress.address2", "level": "order"},
-            "Billing Company": {"path": "order.billingAddress.company", "level": "order"},
-            "Billing City": {"path": "order.billingAddress.city", "level": "order"},
-            "Billing Zip": {"path": "order.billingAddress.zip", "level": "order"},
-            "Billing Province": {"path": "order.billingAddress.provinceCode", "level": "order"},
-            "Billing Country": {"path": "order.billingAddress.countryCode", "level": "order"},
-            "Billing Phone": {"path": "order.billingAddress.phone", "level": "order"},
-            "Shipping Name": {"path": "order.shippingAddress.name", "level": "order"},
-            "Shipping Address1": {"path": "order.shippingAddress.address1", "level": "order"},
-            "Shipping Address2": {"path": "order.shippingAddress.address2", "level": "order"},
-            "Shipping Company": {"path": "order.shippingAddress.company", "level": "order"},
-            "Shipping City": {"path": "order.shippingAddress.city", "level": "order"},
-            "Shipping Zip": {"path": "order.shippingAddress.zip", "level": "order"},
-            "Shipping Province": {"path": "order.shippingAddress.provinceCode", "level": "order"},
-            "Shipping Country": {"path": "order.shippingAddress.countryCode", "level": "order"},
-            "Shipping Phone": {"path": "order.shippingAddress.phone", "level": "order"},
-            "Id": {"path": "order.id", "level": "order"},
-        },
-        "defaults": {
-
-        }
-    },
-    {
-        "location_id": "00000000000",
-        "vendor_name": "vendor3",
-        "output_filename": "filename3",
-        "email_addresses": [
-            "example@example.com",
-            "example2@example.com",
-        ],
-        "columns_order": ["Order Number", "PO Number", "Order Date", "Customer ID", "Billing Full Name",
-                          "Billing First Name", "Billing Last Name", "Billing Street 1", "Billing Street 2", "Billing City",
-                          "Billing State", "Billing ZipCode", "Billing Email", "Billing Phone",
-                          "Billing Country", "Shipping Full Name", "Shipping First Name", "Shipping Last Name",
-                          "Shipping Street 1", "Shipping Street 2", "Shipping City", "Shipping State",
-                          "Shipping ZipCode", "Shipping Email", "Shipping Phone", "Shipping Country",
-                          "Shipping Charge", "Sales Tax", "Shipping Carrier", "Shipping Method", "Ship By Date",
-                          "Shipping Reference 1", "Shipping Reference 2", "3rd Party Shipping Account Number",
-                          "3rd Party Shipping Name", "3rd Party Shipping Address", "3rd Party Shipping City",
-                          "3rd Party Shipping State", "3rd Party Shipping ZipCode", "3rd Party Shipping Country",
-                          "Lineitem sku", "Item Description", "Item Quantity", "Item Price", "Notes"],
-        "mapping": {
-            "Order Number": {"path": "order.name", "level": "order"},
-            "PO Number": {"path": "order.id", "level": "order"},
-            "Order Date": {"path": "createdAt", "level": "order"},
-            "Customer ID": {"path": "order.customer.id", "level": "order"},
-            "Billing Full Name": {"path": "order.billingAddress.name", "level": "order"},
-            "Billing First Name": {"path": "order.billingAddress.firstName", "level": "order"},
-            "Billing Last Name": {"path": "order.billingAddress.lastName", "level": "order"},
-            "Billing Street 1": {"path": "order.billingAddress.address1", "level": "order"},
-            "Billing Street 2": {"path": "order.billingAddress.address2", "level": "order"},
-            "Billing City": {"path": "order.billingAddress.city", "level": "order"},
-            "Billing State": {"path": "order.billingAddress.provinceCode", "level": "order"},
-            "Billing ZipCode": {"path": "order.billingAddress.zip", "level": "order"},
-            "Billing Email": {"path": "order.customer.email", "level": "order"},
-            "Billing Phone": {"path": "order.billingAddress.phone", "level": "order"},
-            "Billing Country": {"path": "order.billingAddress.countryCode", "level": "order"},
-            "Shipping Full Name": {"path": "order.shippingAddress.name", "level": "order"},
-            "Shipping First Name": {"path": "order.shippingAddress.firstName", "level": "order"},
-            "Shipping Last Name": {"path": "order.shippingAddress.lastName", "level": "order"},
-            "Shipping Street 1": {"path": "order.shippingAddress.address1", "level": "order"},
-            "Shipping Street 2": {"path": "order.shippingAddress.address2", "level": "order"},
-            "Shipping City": {"path": "order.shippingAddress.city", "level": "order"},
-            "Shipping State": {"path": "order.shippingAddress.provinceCode", "level": "order"},
-            "Shipping ZipCode": {"path": "order.shippingAddress.zip", "level": "order"},
-            "Shipping Email": {"path": "order.customer.email", "level": "order"},
-            "Shipping Phone": {"path": "order.shippingAddress.phone", "level": "order"},
-            "Shipping Country": {"path": "order.shippingAddress.countryCode", "level": "order"},
-            "Shipping Charge": {"path": "static", "level": "static", "value": ""},
-            "Sales Tax": {"path": "static", "level": "static", "value": ""},
-            "Shipping Carrier": {"path": "static", "level": "static", "value": "FedEx"},
-            "Shipping Method": {"path": "order.shippingLine.title", "level": "order"},
-            "Ship By Date": {"path": "static", "level": "static", "value": ""},
-            "Shipping Reference 1": {"path": "static", "level": "static", "value": ""},
-            "Shipping Reference 2": {"path": "static", "level": "static", "value": ""},
-            "3rd Party Shipping Account Number": {"path": "static", "level": "static", "value": "000000000"},
-            "3rd Party Shipping Name": {"path": "static", "level": "static", "value": ""},
-            "3rd Party Shipping Address": {"path": "static", "level": "static", "value": ""},
-            "3rd Party Shipping City": {"path": "static", "level": "static", "value": ""},
-            "3rd Party Shipping State": {"path": "static", "level": "static", "value": ""},
-            "3rd Party Shipping ZipCode": {"path": "static", "level": "static", "value": ""},
-            "3rd Party Shipping Country": {"path": "static", "level": "static", "value": ""},
-            "Lineitem sku": {"path": "sku", "level": "line_item"},
-            "Item Description": {"path": "productTitle", "level": "line_item"},
-            "Item Quantity": {"path": "totalQuantity", "level": "line_item"},
-            "Item Price": {"path": "static", "level": "static", "value": ""},
-            "Notes": {"path": "static", "level": "static", "value": ""}
-        },
-        "defaults": {
-            "Shipping Charge": "",
-            "Sales Tax": "",
-            "Shipping Carrier": "FedEx",
-            "Ship By Date": "",
-            "Shipping Reference 1": "",
-            "Shipping Reference 2": "",
-            "3rd Party Shipping Account Number": "000000000",
-            "3rd Party Shipping Name": "",
-            "3rd Party Shipping Address": "",
-            "3rd Party Shipping City": "",
-            "3rd Party Shipping State": "",
-            "3rd Party Shipping ZipCode": "",
-            "3rd Party Shipping Country": "",
-            "Item Price": "",
-            "Notes": ""
-        }
-    }
-    # Add similar entries for other vendors
-]
-
-# Loop through vendors
-for vendor_details in vendors:
-    vendor_formatter = VendorFormatter(vendor_details["location_id"], vendor_details["output_filename"])
-    vendor_formatter.set_mapping(vendor_details["columns_order"], vendor_details["mapping"])
-    vendor_formatter.set_defaults(vendor_details.get("defaults",{}))
-    vendor_formatter.run_query_and_format()
 
+def email_vendor_file(vendor_details, mailer, run_date, attachment_paths):
     # Email the generated file(s)
     vendor_name = f"{vendor_details['vendor_name']}"
-    email_subject = f"Orders {month_number}-{day}"
+    email_subject = f"Orders {run_date.strftime('%m-%d')}"
     email_recipient = vendor_details.get("email_addresses", [])
-    attachment_path = f"{path_prefix}{vendor_details['output_filename']}.xlsx"
     cc_emails = ["cc@example.com", "cc2@example.com"]
     email_body = "Place your email text here, using \n for line breaks"
     email_signature_html = """
 If you have an HTML/formatted/styled email signature, you can paste the code here.
 """
 
-    create_and_draft_email(email_recipient, email_subject, email_body, email_signature_html, attachment_path, cc_emails, vendor_name)
-input("Finished processing orders, press Enter to exit...")    
+    mailer.queue_draft(email_recipient, email_subject, email_body, email_signature_html, attachment_paths, cc_emails, vendor_name)
+
+
+def fetch_location(location_fetcher):
+    """
+    Download one location's orders, mapping them for all of its vendors.
+    Returns (start time, error), the error being empty when the fetch worked.
+    """
+    start_time = time.monotonic()
+    try:
+        with metrics.timer("fetch", f"location {location_fetcher.location_id}"):
+            location_fetcher.fetch_orders()
+    except Exception as e:
+        return start_time, f"fetch: {e}"
+    return start_time, ""
+
+
+def finish_vendor(location_fetcher, vendor_details, vendor_formatter, mailer, run_date, start_time, dry_run=False,
+                  file_suffix=""):
+    """
+    Write one vendor's files, save its cursor and queue its email, once its
+    location has been fetched. A dry run stops after mapping: no files, drafts
+    or saved cursors. file_suffix is added to the file names, e.g. a cycle's
+    time in the resident service. Returns the vendor's summary row, with the
+    seconds since its location's fetch started.
+    """
+    result = {"vendor": vendor_details["vendor_name"], "location_id": location_fetcher.location_id,
+              "status": "ok", "rows": vendor_formatter.row_count(), "error": ""}
+    try:
+        if not dry_run:
+            attachment_paths = vendor_formatter.write_output(output_path_prefix(run_date), file_suffix)
+            location_fetcher.commit_vendor(vendor_formatter)
+            email_vendor_file(vendor_details, mailer, run_date, attachment_paths)
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result["seconds"] = time.monotonic() - start_time
+    return result
+
+
+def run_vendor_pipelines(location_fetchers, mailer, max_workers=4, run_date=None, dry_run=False, file_suffix=""):
+    """
+    Fetch every location and then finish each of its vendors, all on one
+    bounded thread pool. Vendors sharing a location are written at the same
+    time once its fetch is done, so a slow vendor doesn't hold up the others.
+    Shopify calls from every worker share shopify_module.rate_budget, so more
+    workers don't mean more throttling. Errors are caught per vendor so one bad
+    vendor doesn't stop the others.
+    Once every vendor is done, the remaining drafts are flushed and each
+    vendor's email outcome is added to its summary row. mailer is None on dry runs.
+    """
+    run_date = run_date or datetime.now()
+    vendor_results = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # Only this thread submits, so no worker ever waits on another task in the pool
+        fetches = {executor.submit(fetch_location, location_fetcher): location_fetcher
+                   for location_fetcher in location_fetchers}
+        for fetch in as_completed(fetches):
+            location_fetcher = fetches[fetch]
+            start_time, error = fetch.result()
+            if error:
+                vendor_results[location_fetcher] = [
+                    {"vendor": vendor_details["vendor_name"], "location_id": location_fetcher.location_id,
+                     "status": "failed", "rows": 0, "seconds": time.monotonic() - start_time, "error": error}
+                    for vendor_details, vendor_formatter in location_fetcher.vendors]
+            else:
+                vendor_results[location_fetcher] = [
+                    executor.submit(finish_vendor, location_fetcher, vendor_details, vendor_formatter, mailer,
+                                    run_date, start_time, dry_run, file_suffix)
+                    for vendor_details, vendor_formatter in location_fetcher.vendors]
+
+    # Summary rows in the order the vendors were planned
+    results = [result if isinstance(result, dict) else result.result()
+               for location_fetcher in location_fetchers for result in vendor_results[location_fetcher]]
+
+    email_results = mailer.flush([result["vendor"] for result in results]) if mailer is not None else {}
+    for result in results:
+        if result["vendor"] not in email_results:
+            result["email"] = "-"
+        elif email_results[result["vendor"]] is None:
+            result["email"] = "drafted"
+        else:
+            result["email"] = "failed"
+            result["status"] = "failed"
+            result["error"] = result["error"] or f"email: {email_results[result['vendor']]}"
+    return results
+
+
+def print_run_summary(results):
+    headers = ["Vendor", "Location", "Status", "Rows", "Seconds", "Email", "Error"]
+    rows = [[r["vendor"], r["location_id"], r["status"], str(r["rows"]), f"{r['seconds']:.1f}", r.get("email", "-"), r["error"]]
+            for r in results]
+    widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *rows)]
+
+    print()
+    print("  ".join(header.ljust(width) for header, width in zip(headers, widths)))
+    print("  ".join("-" * width for width in widths))
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+def print_shopify_stats(stats):
+    line = f"Shopify requests: {stats['requests']} ({stats['retries']} retried, {stats['throttled']} throttled)"
+    if stats["requests"]:
+        line += f", latency mean {stats['mean']:.2f}s / p95 {stats['p95']:.2f}s / max {stats['max']:.2f}s"
+    print(line)
+
+
+def write_run_reports(run_results, shopify_stats, report_path, dry_run=False, metrics_report=None):
+    # JSON report (the whole run's metrics unless metrics_report is given), plus a Prometheus textfile
+    # with the process totals when METRICS_PROMETHEUS is set
+    if report_path:
+        metrics.write_json(report_path, {"vendors": run_results, "shopify": shopify_stats, "dry_run": dry_run},
+                           metrics_report)
+        print(f"Run report written to {report_path}")
+
+    prometheus_path = os.getenv("METRICS_PROMETHEUS")
+    if prometheus_path:
+        metrics.write_prometheus(prometheus_path)
+
+
+def parse_run_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a date like 2024-03-15, got {value!r}")
+
+
+def add_common_options(parser, suppress_defaults=False):
+    # Subcommands repeat these with SUPPRESS defaults so they can go before or after the subcommand
+    parser.add_argument("--date", type=parse_run_date, default=argparse.SUPPRESS if suppress_defaults else None,
+                        help="date for the output folder and email subject, YYYY-MM-DD (default: today)")
+    parser.add_argument("--headless", action="store_true", default=argparse.SUPPRESS if suppress_defaults else False,
+                        help="don't wait for Enter when finished (implied when stdin isn't a terminal)")
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Export Shopify fulfillment orders into vendor files and draft the emails.")
+    add_common_options(parser)
+    subparsers = parser.add_subparsers(dest="command", metavar="{run,dry-run,vendor,serve}")
+
+    run_parser = subparsers.add_parser("run", help="export every vendor and draft the emails (default)")
+    dry_run_parser = subparsers.add_parser("dry-run", help="fetch and map every vendor without writing files, "
+                                                           "drafting emails or saving cursors")
+    vendor_parser = subparsers.add_parser("vendor", help="run a single vendor")
+    vendor_parser.add_argument("vendor_name", help="the vendor_name of a file in the vendor directory")
+    vendor_parser.add_argument("--dry-run", action="store_true", help="fetch and map only, as with dry-run")
+    for subparser in (run_parser, dry_run_parser, vendor_parser):
+        add_common_options(subparser, suppress_defaults=True)
+
+    serve_parser = subparsers.add_parser("serve", help="stay running and export each location on an interval")
+    serve_parser.add_argument("--port", type=int, default=int(os.getenv("SERVE_PORT", "8765")),
+                              help="localhost port for POST /trigger and GET /status (default 8765)")
+    serve_parser.add_argument("--interval", type=float, default=float(os.getenv("POLL_INTERVAL", "900")),
+                              help="seconds between cycles for locations whose vendors don't set poll_interval")
+
+    return parser.parse_args(argv)
+
+
+def serve(selected_vendors, port, default_interval):
+    """
+    Resident mode: the Shopify transport, Gmail service and compiled vendor
+    formatters are created once and reused by every cycle. Each location is
+    polled on the shortest poll_interval of its vendors, and can be run early
+    with POST /trigger. A cycle only exports orders after the saved cursors,
+    and its files are named with the cycle's time inside that day's folder,
+    so the output rolls over to a new folder at midnight. Each cycle writes
+    run_report_<location>_<HHMMSS>.json with only that cycle's metrics.
+    """
+    from email_module import GmailMailer
+    from service_module import PollScheduler, TriggerServer
+
+    state_store = StateStore(os.getenv("STATE_DB", "state.db"))
+    mailer = GmailMailer(int(os.getenv("GMAIL_BATCH_SIZE", "10")), api_endpoint=os.getenv("GMAIL_API_ENDPOINT"))
+    prefetch_pages = int(os.getenv("PREFETCH_PAGES", "2"))
+    engine = os.getenv("MAPPING_ENGINE", "dict")
+    formatters = {vendor_details["vendor_name"]: build_vendor_formatter(vendor_details, state_store)
+                  for vendor_details in selected_vendors}
+
+    vendors_by_location = {}
+    for vendor_details in selected_vendors:
+        vendors_by_location.setdefault(vendor_details["location_id"], []).append(vendor_details)
+    intervals = {location_id: min(vendor_details.get("poll_interval", default_interval)
+                                  for vendor_details in location_vendors)
+                 for location_id, location_vendors in vendors_by_location.items()}
+
+    def run_cycle(location_id):
+        # The date is read every cycle so files go into the right day's folder
+        run_date = datetime.now()
+        started_at = time.time()
+        # Bulk exports always start from the first order, so cycles page
+        location_fetchers = plan_location_fetches(vendors_by_location[location_id], state_store, False,
+                                                  prefetch_pages, engine, formatters)
+        results = run_vendor_pipelines(location_fetchers, mailer, 1, run_date,
+                                       file_suffix=run_date.strftime("_%H%M%S"))
+        print(f"\nCycle for location {location_id} at {run_date:%Y-%m-%d %H:%M:%S}")
+        print_run_summary(results)
+        # Take out just this location's scopes; cycles for other locations may still be running
+        scope = f"location {location_id}"
+        cycle_metrics = metrics.take([scope] + [vendor_details["vendor_name"]
+                                                for vendor_details in vendors_by_location[location_id]], started_at)
+        write_run_reports(results, get_transport().latency_stats(scope, reset=True),
+                          f"{output_path_prefix(run_date)}run_report_{location_id}_{run_date:%H%M%S}.json",
+                          metrics_report=cycle_metrics)
+
+    scheduler = PollScheduler(intervals, run_cycle, int(os.getenv("MAX_WORKERS", "4")))
+    trigger_server = TriggerServer(scheduler, port=port)
+    print(f"Serving {len(intervals)} location(s), trigger and status at {trigger_server.start()}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        print("Stopped")
+    finally:
+        trigger_server.stop()
+        mailer.close()
+        state_store.close()
+
+
+def main(argv=None):
+    # Load environment variables from .env, first so they can supply argument defaults
+    load_dotenv()
+
+    args = parse_arguments(argv)
+    dry_run = args.command == "dry-run" or getattr(args, "dry_run", False)
+
+    try:
+        # Dry runs leave no files behind, the plan cache included
+        vendors = load_vendors(os.getenv("VENDOR_DIR") or DEFAULT_VENDOR_DIR,
+                               os.getenv("VENDOR_PLAN_CACHE", "vendor_plans.json") or None, update_cache=not dry_run)
+    except VendorConfigError as e:
+        print(e)
+        return 2
+
+    if args.command == "serve":
+        if args.date:
+            print("serve always uses the current date, --date can't be combined with it")
+            return 2
+        serve(vendors, args.port, args.interval)
+        return 0
+
+    run_date = args.date or datetime.now()
+    path_prefix = output_path_prefix(run_date)
+
+    selected_vendors = vendors
+    if args.command == "vendor":
+        selected_vendors = [vendor_details for vendor_details in vendors if vendor_details["vendor_name"] == args.vendor_name]
+        if not selected_vendors:
+            print(f"Unknown vendor {args.vendor_name!r}, expected one of: "
+                  f"{', '.join(vendor_details['vendor_name'] for vendor_details in vendors)}")
+            return 2
+
+    with Profiler(os.getenv("PROFILE", ""), f"{path_prefix}profile"):
+        # Download each location once and fan the pages out to its vendors, several locations at a time
+        state_db = os.getenv("STATE_DB", "state.db")
+        if not dry_run:
+            state_store = StateStore(state_db)
+        elif os.path.exists(state_db):
+            # A dry run reads the saved cursors but never creates or changes the database
+            state_store = StateStore(state_db, read_only=True)
+        else:
+            state_store = None
+        location_fetchers = plan_location_fetches(selected_vendors, state_store, os.getenv("BULK_MODE") == "1",
+                                                  int(os.getenv("PREFETCH_PAGES", "2")), os.getenv("MAPPING_ENGINE", "dict"))
+        mailer = None
+        if not dry_run:
+            # The Google API client is slow to import, so only load it when drafts will be created
+            from email_module import GmailMailer
+            mailer = GmailMailer(int(os.getenv("GMAIL_BATCH_SIZE", "10")), api_endpoint=os.getenv("GMAIL_API_ENDPOINT"))
+        run_results = run_vendor_pipelines(location_fetchers, mailer, int(os.getenv("MAX_WORKERS", "4")),
+                                           run_date, dry_run)
+        if mailer is not None:
+            mailer.close()
+        if state_store is not None:
+            state_store.close()
+
+    print_run_summary(run_results)
+    print_shopify_stats(get_transport().latency_stats())
+    write_run_reports(run_results, get_transport().latency_stats(),
+                      os.getenv("METRICS_REPORT") or ("" if dry_run else f"{path_prefix}run_report.json"), dry_run)
+
+    # Keep the window open when run by hand; cron and schedulers have no terminal to answer
+    if not (args.headless or os.getenv("HEADLESS") == "1") and sys.stdin.isatty():
+        input("Finished processing orders, press Enter to exit...")
+
+    return 0 if all(result["status"] == "ok" for result in run_results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Building blocks for running the exporter as a resident service.
+
+PollScheduler runs a job for each key (a location) on its own interval, or
+straight away when triggered. TriggerServer exposes the triggers and the
+scheduler's status over HTTP on localhost:
+
+    curl -X POST http://127.0.0.1:8765/trigger
+    curl -X POST "http://127.0.0.1:8765/trigger?location=00000000000"
+    curl http://127.0.0.1:8765/status
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class PollScheduler:
+    """
+    Calls job(key) every intervals[key] seconds. A key never runs twice at
+    once: a trigger or a due time that arrives while its job is running is
+    picked up when the job finishes. Different keys run in parallel on up to
+    max_workers threads.
+    """
+    def __init__(self, intervals, job, max_workers=4):
+        self.intervals = dict(intervals)
+        self.job = job
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self.condition = threading.Condition()
+        self.stopping = False
+        # Everything is due on start-up
+        now = time.monotonic()
+        self.next_due = {key: now for key in self.intervals}
+        self.running = set()
+        self.status_by_key = {key: {"interval": interval, "runs": 0, "last_started": None, "last_finished": None,
+                                    "last_seconds": None, "last_error": None}
+                              for key, interval in self.intervals.items()}
+
+    def trigger(self, key=None):
+        """Run one key, or every key when key is None, as soon as possible. Returns the keys triggered."""
+        keys = list(self.intervals) if key is None else [key]
+        if any(k not in self.intervals for k in keys):
+            raise KeyError(key)
+        with self.condition:
+            now = time.monotonic()
+            for k in keys:
+                self.next_due[k] = min(self.next_due[k], now)
+            self.condition.notify_all()
+        return keys
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+    def run_forever(self):
+        """
+        Dispatch due jobs until stop() is called, then wait for running jobs to
+        finish. Running jobs are also waited for on KeyboardInterrupt.
+        """
+        try:
+            with self.condition:
+                while not self.stopping:
+                    now = time.monotonic()
+                    for key, due in self.next_due.items():
+                        if due <= now and key not in self.running:
+                            self.running.add(key)
+                            self.executor.submit(self.run_job, key)
+
+                    waiting = [due for key, due in self.next_due.items() if key not in self.running]
+                    timeout = max(0.0, min(waiting) - now) if waiting else None
+                    self.condition.wait(timeout)
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def run_job(self, key):
+        started = time.time()
+        start_time = time.monotonic()
+        error = None
+        with self.condition:
+            # The next run is measured from this one's start, so a slow cycle doesn't push the schedule back
+            self.next_due[key] = start_time + self.intervals[key]
+            self.status_by_key[key]["last_started"] = started
+
+        try:
+            self.job(key)
+        except Exception as e:
+            error = str(e)
+            print(f"Cycle for {key} failed: {e}")
+
+        with self.condition:
+            self.running.discard(key)
+            status = self.status_by_key[key]
+            status["runs"] += 1
+            status["last_finished"] = time.time()
+            status["last_seconds"] = round(time.monotonic() - start_time, 3)
+            status["last_error"] = error
+            self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            now = time.monotonic()
+            return {
+                str(key): dict(status, running=key in self.running,
+                               next_run_in=round(max(0.0, self.next_due[key] - now), 1))
+                for key, status in self.status_by_key.items()
+            }
+
+
+class TriggerServer:
+    """
+    Localhost HTTP endpoint for a PollScheduler:
+      POST /trigger[?location=<key>]  run every key, or one key, now
+      GET  /status                    the scheduler's per-key status as JSON
+    """
+    def __init__(self, scheduler, host="127.0.0.1", port=8765):
+        self.scheduler = scheduler
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def make_handler(self):
+        scheduler = self.scheduler
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_json(self, status, payload):
+                body = json.dumps(payload, indent=2).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if urlparse(self.path).path == "/status":
+                    self.send_json(200, scheduler.status())
+                else:
+                    self.send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != "/trigger":
+                    self.send_json(404, {"error": "not found"})
+                    return
+                location = parse_qs(url.query).get("location", [None])[0]
+                try:
+                    triggered = scheduler.trigger(location)
+                except KeyError:
+                    self.send_json(404, {"error": f"unknown location {location}"})
+                    return
+                self.send_json(202, {"triggered": [str(key) for key in triggered]})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,758 @@
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache_module import CacheMissError, cache_from_env
+from metrics_module import metrics
+
+# Rough cost of a fulfillmentOrders page before Shopify has told us the real figure
+DEFAULT_QUERY_COST = 150
+# Request times kept per scope for latency_stats(), so a resident process doesn't grow without bound
+LATENCY_WINDOW = 10000
+
+
+class ShopifyRateBudget:
+    """
+    Local estimate of the Shopify GraphQL cost bucket, shared by every thread.
+    Requests reserve their estimated cost up front and wait for the bucket to
+    refill instead of being throttled by Shopify.
+    """
+    def __init__(self, maximum_available=1000.0, restore_rate=50.0):
+        self.maximum_available = maximum_available
+        self.restore_rate = restore_rate
+        self.currently_available = maximum_available
+        self.in_flight = 0.0
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _restore(self):
+        now = time.monotonic()
+        self.currently_available = min(self.maximum_available,
+                                       self.currently_available + (now - self.last_update) * self.restore_rate)
+        self.last_update = now
+
+    def acquire(self, cost):
+        # A single query can never cost more than the whole bucket
+        cost = min(cost, self.maximum_available)
+        while True:
+            with self.lock:
+                self._restore()
+                if self.currently_available - self.in_flight >= cost:
+                    self.in_flight += cost
+                    return cost
+                wait = (cost - self.currently_available + self.in_flight) / self.restore_rate
+            time.sleep(max(wait, 0.05))
+
+    def release(self, reserved, cost_extension=None):
+        """
+        Drop a reservation and resync with the throttleStatus Shopify sent back,
+        which already includes the points the request actually used.
+        """
+        throttle_status = (cost_extension or {}).get("throttleStatus")
+        with self.lock:
+            self.in_flight = max(0.0, self.in_flight - reserved)
+            if throttle_status:
+                self.maximum_available = float(throttle_status["maximumAvailable"])
+                self.restore_rate = float(throttle_status["restoreRate"])
+                self.currently_available = float(throttle_status["currentlyAvailable"])
+                self.last_update = time.monotonic()
+            else:
+                self._restore()
+                self.currently_available -= reserved
+
+
+# One budget per process: every location and vendor draws from the same store bucket
+rate_budget = ShopifyRateBudget()
+
+
+class ShopifyError(Exception):
+    pass
+
+
+class ShopifyTransport:
+    """
+    Keep-alive HTTP transport for the Shopify GraphQL endpoint.
+
+    Requests go through one pooled requests.Session with gzip and timeouts.
+    HTTP 429 / 5xx responses, connection errors and GraphQL THROTTLED errors
+    are retried up to max_retries times, waiting for Retry-After or for the
+    bucket to restore enough points. Every attempt is timed for latency_stats(),
+    grouped by the caller's scope so one location's figures can be read alone.
+
+    With a ResponseCache, "record" saves every successful response and
+    "replay" answers from the cache without touching the network.
+    """
+    def __init__(self, endpoint, access_token, timeout=(5, 60), max_retries=5, pool_size=10,
+                 budget=None, backoff_base=0.5, backoff_max=30.0, cache=None):
+        self.endpoint = endpoint
+        self.cache = cache
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.budget = budget or rate_budget
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "X-Shopify-Access-Token": access_token or "",
+        })
+
+        self.stats_lock = threading.Lock()
+        # scope -> [retries, throttled, the latest LATENCY_WINDOW request times]
+        self.scope_stats = {}
+        # Totals for the life of the transport
+        self.retries = 0
+        self.throttled = 0
+
+    def backoff(self, attempt):
+        return min(self.backoff_max, self.backoff_base * 2 ** attempt)
+
+    def get_scope_stats(self, scope):
+        # Called with self.stats_lock held
+        if scope not in self.scope_stats:
+            self.scope_stats[scope] = [0, 0, deque(maxlen=LATENCY_WINDOW)]
+        return self.scope_stats[scope]
+
+    def record_latency(self, seconds, scope=""):
+        with self.stats_lock:
+            self.get_scope_stats(scope)[2].append(seconds)
+
+    def record_retry(self, throttled=False, scope=""):
+        with self.stats_lock:
+            scope_stats = self.get_scope_stats(scope)
+            self.retries += 1
+            scope_stats[0] += 1
+            if throttled:
+                self.throttled += 1
+                scope_stats[1] += 1
+        metrics.increment("graphql_throttled" if throttled else "graphql_retries", scope=scope)
+
+    def record_response(self, size, cost, scope, throttled=False):
+        # A throttled query never ran, so it isn't counted as a request or charged; only the
+        # bucket level it reported is kept (graphql_throttled counts the attempt)
+        if cost and cost.get("throttleStatus"):
+            metrics.set_gauge("graphql_throttle_available", cost["throttleStatus"]["currentlyAvailable"], scope=scope)
+        if throttled:
+            return
+        metrics.increment("graphql_requests", scope=scope)
+        metrics.increment("graphql_bytes", size, scope=scope)
+        if cost:
+            metrics.increment("graphql_query_cost", cost.get("actualQueryCost") or cost.get("requestedQueryCost") or 0,
+                              scope=scope)
+
+    def execute(self, query, variables, estimated_cost=DEFAULT_QUERY_COST, scope=""):
+        """
+        Run a GraphQL query and return the decoded response, retrying throttles and transient failures.
+        Time, bytes, cost and throttle status are recorded in metrics under scope.
+        """
+        with metrics.timer("graphql", scope):
+            return self.send(query, variables, estimated_cost, scope)
+
+    def send(self, query, variables, estimated_cost, scope):
+        if self.cache is not None and self.cache.mode == "replay":
+            start_time = time.perf_counter()
+            try:
+                return self.cache.load(query, variables)
+            except CacheMissError as e:
+                raise ShopifyError(f"Replay cache miss: {e}") from e
+            finally:
+                self.record_latency(time.perf_counter() - start_time, scope)
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            reserved = self.budget.acquire(estimated_cost)
+
+            start_time = time.perf_counter()
+            try:
+                response = self.session.post(self.endpoint, json={"query": query, "variables": variables},
+                                             timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.budget.release(reserved)
+                if last_attempt:
+                    raise ShopifyError(f"Shopify request failed after {attempt + 1} attempts: {e}") from e
+                self.record_retry(scope=scope)
+                time.sleep(self.backoff(attempt))
+                continue
+            finally:
+                self.record_latency(time.perf_counter() - start_time, scope)
+
+            if response.status_code == 429 or response.status_code >= 500:
+                self.budget.release(reserved)
+                if last_attempt:
+                    raise ShopifyError(f"Shopify returned HTTP {response.status_code} after {attempt + 1} attempts")
+                retry_after = response.headers.get("Retry-After")
+                self.record_retry(throttled=response.status_code == 429, scope=scope)
+                time.sleep(float(retry_after) if retry_after else self.backoff(attempt))
+                continue
+
+            if response.status_code != 200:
+                self.budget.release(reserved)
+                raise ShopifyError(f"Shopify returned HTTP {response.status_code}: {response.text[:200]}")
+
+            try:
+                data = response.json()
+            except ValueError as e:
+                self.budget.release(reserved)
+                raise ShopifyError(f"Shopify returned a response that isn't JSON: {response.text[:200]}") from e
+
+            cost = data.get("extensions", {}).get("cost")
+            self.budget.release(reserved, cost)
+
+            errors = data.get("errors") or []
+            throttled = any(error.get("extensions", {}).get("code") == "THROTTLED" for error in errors)
+            self.record_response(len(response.content), cost, scope, throttled)
+            if throttled:
+                if last_attempt:
+                    raise ShopifyError(f"Shopify kept throttling the query after {attempt + 1} attempts")
+                self.record_retry(throttled=True, scope=scope)
+                time.sleep(self.throttle_wait(cost, attempt))
+                continue
+
+            if errors and not data.get("data"):
+                raise ShopifyError("; ".join(error.get("message", str(error)) for error in errors))
+
+            if self.cache is not None:
+                self.cache.save(query, variables, data)
+            return data
+
+    def throttle_wait(self, cost, attempt):
+        # Wait exactly long enough for the bucket to refill to the requested cost
+        throttle_status = (cost or {}).get("throttleStatus")
+        if throttle_status and cost.get("requestedQueryCost"):
+            missing = cost["requestedQueryCost"] - throttle_status["currentlyAvailable"]
+            return max(missing / throttle_status["restoreRate"], 0.1)
+        return self.backoff(attempt)
+
+    def stream(self, url):
+        """GET a file (e.g. a bulk operation result) over the pooled session, streamed."""
+        if self.cache is not None and self.cache.mode == "replay":
+            raise ShopifyError("Bulk result files aren't recorded, replay runs have to use paged mode (BULK_MODE=0)")
+        # Result files live on third-party storage, don't send them the access token
+        response = self.session.get(url, stream=True, timeout=self.timeout, headers={"X-Shopify-Access-Token": None})
+        response.raise_for_status()
+        return response
+
+    def latency_stats(self, scope=None, reset=False):
+        """
+        Request count, retries and latency percentiles, over the latest
+        LATENCY_WINDOW requests per scope. With a scope, only its requests;
+        reset then starts that scope over, e.g. for each serve cycle.
+        """
+        with self.stats_lock:
+            if scope is None:
+                latencies = sorted(seconds for scope_stats in self.scope_stats.values() for seconds in scope_stats[2])
+                retries, throttled = self.retries, self.throttled
+            else:
+                retries, throttled, scope_latencies = self.scope_stats.get(scope, (0, 0, ()))
+                latencies = sorted(scope_latencies)
+                if reset:
+                    self.scope_stats.pop(scope, None)
+        if not latencies:
+            return {"requests": 0, "retries": retries, "throttled": throttled}
+
+        def percentile(fraction):
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+        return {
+            "requests": len(latencies),
+            "retries": retries,
+            "throttled": throttled,
+            "mean": sum(latencies) / len(latencies),
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "max": latencies[-1],
+        }
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    The process-wide transport, built on first use from .env:
+    ENDPOINT_URL, ACCESS_TOKEN, SHOPIFY_TIMEOUT, SHOPIFY_MAX_RETRIES and,
+    for recorded runs, SHOPIFY_CACHE_MODE / SHOPIFY_CACHE_DIR.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = ShopifyTransport(
+                # Your Shopify GraphQL endpoint
+                os.getenv("ENDPOINT_URL"),
+                # Your Shopify access token
+                os.getenv("ACCESS_TOKEN"),
+                timeout=(5, float(os.getenv("SHOPIFY_TIMEOUT", "60"))),
+                max_retries=int(os.getenv("SHOPIFY_MAX_RETRIES", "5")),
+                cache=cache_from_env(),
+            )
+        return _transport
+
+
+def execute_graphql(query, variables, estimated_cost=DEFAULT_QUERY_COST, scope=""):
+    """Send a query to the Shopify GraphQL endpoint through the shared transport."""
+    return get_transport().execute(query, variables, estimated_cost, scope)
+
+
+_END_OF_PAGES = object()
+
+
+def prefetch(pages, depth=2):
+    """
+    Iterate over `pages` on a background thread, keeping up to `depth` items
+    ready in a bounded queue. The next page is downloaded while the caller is
+    still mapping the current one. Items come out in the same order, and an
+    exception in the producer is raised in the caller once it reaches that point.
+    """
+    if depth <= 0:
+        yield from pages
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item):
+        # Give up if the consumer has stopped reading, instead of blocking forever
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+        except BaseException as e:
+            put((_END_OF_PAGES, e))
+            return
+        put((_END_OF_PAGES, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            page, error = buffer.get()
+            if page is _END_OF_PAGES:
+                if error is not None:
+                    raise error
+                return
+            yield page
+    finally:
+        stopped.set()
+        producer.join()
+
+
+class PageSizer:
+    """
+    Picks the next fulfillmentOrders page size from the cost Shopify reported
+    for the previous page, so each round trip uses as much of the available
+    query budget as it can without being throttled.
+    """
+    def __init__(self, first=5, minimum=1, maximum=250, max_query_cost=1000, budget_share=0.9):
+        self.first = first
+        self.minimum = minimum
+        self.maximum = maximum
+        # Shopify rejects any single query above this cost
+        self.max_query_cost = max_query_cost
+        # Leave some of the bucket for other locations running at the same time
+        self.budget_share = budget_share
+        self.cost_per_order = None
+
+    def estimated_cost(self):
+        if self.cost_per_order is None:
+            return DEFAULT_QUERY_COST
+        # One order of headroom for the connection overhead that doesn't scale with page size
+        return self.cost_per_order * (self.first + 1)
+
+    def update(self, cost_extension):
+        if not cost_extension or not cost_extension.get("requestedQueryCost"):
+            return self.first
+
+        self.cost_per_order = cost_extension["requestedQueryCost"] / self.first
+
+        budget = self.max_query_cost
+        throttle_status = cost_extension.get("throttleStatus")
+        if throttle_status:
+            budget = min(budget, throttle_status["currentlyAvailable"])
+
+        next_first = int(budget * self.budget_share // self.cost_per_order)
+        # Grow gradually so one cheap page doesn't make us overshoot, shrink immediately
+        self.first = max(self.minimum, min(self.maximum, next_first, self.first * 2))
+        return self.first
+
+
+def build_selection(paths, indent):
+    """
+    Render dotted field paths as the body of a GraphQL selection set, e.g.
+    ["order.name", "order.shippingAddress.zip"] -> order { name shippingAddress { zip } }.
+    Numeric parts are list indexes and don't appear in the query. Fields are
+    sorted so the same paths always give the same query text.
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        for field in path.split("."):
+            if not field.isdigit():
+                node = node.setdefault(field, {})
+
+    def render(node, depth):
+        lines = []
+        for field in sorted(node):
+            if node[field]:
+                lines.append(" " * depth + field + " {")
+                lines.extend(render(node[field], depth + 4))
+                lines.append(" " * depth + "}")
+            else:
+                lines.append(" " * depth + field)
+        return lines
+
+    return "\n" + "\n".join(render(tree, indent)) + "\n"
+
+
+@lru_cache(maxsize=None)
+def build_fulfillment_orders_query(order_paths, line_item_paths):
+    """
+    Build the paged fulfillmentOrders query for a set of mapped paths: order_paths
+    relative to the fulfillment order, line_item_paths relative to a line item
+    (both frozensets, so the result is cached per mapping set).
+    Returns (query, fulfillment order selection, line item selection); the
+    selections are reused by the follow-up line item and bulk queries.
+    """
+    fulfillment_order_fields = build_selection(order_paths, 16)
+    line_item_fields = build_selection(line_item_paths, 24)
+
+    query = f"""
+    query FulfillmentOrders($locationId: String!, $after: String, $first: Int!, $lineItemsFirst: Int!) {{
+        fulfillmentOrders(
+            first: $first
+            query: $locationId
+            includeClosed: true
+            after: $after
+        ) {{
+            nodes {{{fulfillment_order_fields}                lineItems(first: $lineItemsFirst) {{
+                    pageInfo {{
+                        hasNextPage
+                        endCursor
+                    }}
+                    nodes {{{line_item_fields}                    }}
+                }}
+            }}
+            pageInfo {{
+                endCursor
+                hasNextPage
+            }}
+        }}
+    }}
+    """
+    return query, fulfillment_order_fields, line_item_fields
+
+
+def build_remaining_line_items_query(batch_size, line_items_first, line_item_fields):
+    """
+    Build one query that continues the lineItems connection of several
+    fulfillment orders at once, using an aliased node() lookup per order.
+    Variables are id0/after0, id1/after1, ...
+    """
+    arguments = ", ".join(f"$id{i}: ID!, $after{i}: String" for i in range(batch_size))
+    selections = "\n".join(
+        f"""
+            fo{i}: node(id: $id{i}) {{
+                ... on FulfillmentOrder {{
+                    lineItems(first: {line_items_first}, after: $after{i}) {{
+                        pageInfo {{
+                            hasNextPage
+                            endCursor
+                        }}
+                        nodes {{
+                            {line_item_fields}
+                        }}
+                    }}
+                }}
+            }}"""
+        for i in range(batch_size)
+    )
+    return f"query RemainingLineItems({arguments}) {{{selections}\n}}"
+
+
+class FulfillmentOrderPager:
+    """
+    Pages through a location's fulfillment orders, resizing every page with a
+    PageSizer and fetching the rest of any lineItems connection that didn't
+    fit in the first page of line items. Requests go through the shared
+    transport unless another one is passed in.
+    """
+    def __init__(self, location_id, query, line_item_fields, page_sizer=None,
+                 line_items_first=25, remaining_line_items_first=100, transport=None):
+        self.location_id = location_id
+        self.query = query
+        self.line_item_fields = line_item_fields
+        self.page_sizer = page_sizer or PageSizer()
+        self.line_items_first = line_items_first
+        self.remaining_line_items_first = remaining_line_items_first
+        self.execute = transport.execute if transport is not None else execute_graphql
+        # GraphQL metrics for the location, shared by its vendors
+        self.scope = f"location {location_id}"
+
+    def pages(self, cursor=None):
+        """
+        Yield (order_nodes, end_cursor, has_next_page) for each page after cursor.
+        Every order node has its complete list of line items.
+        """
+        while True:
+            data = self.execute(
+                self.query,
+                {
+                    "locationId": f"assigned_location_id:{self.location_id}",
+                    "after": cursor,
+                    "first": self.page_sizer.first,
+                    "lineItemsFirst": self.line_items_first,
+                },
+                self.page_sizer.estimated_cost(),
+                self.scope,
+            )
+            self.page_sizer.update(data.get("extensions", {}).get("cost"))
+
+            fulfillment_orders = data["data"]["fulfillmentOrders"]
+            order_nodes = fulfillment_orders["nodes"]
+            metrics.increment("pages", scope=self.scope)
+            metrics.increment("orders_fetched", len(order_nodes), scope=self.scope)
+            self.fetch_remaining_line_items(order_nodes)
+
+            cursor = fulfillment_orders["pageInfo"]["endCursor"]
+            has_next_page = fulfillment_orders["pageInfo"]["hasNextPage"]
+            yield order_nodes, cursor, has_next_page
+
+            if not has_next_page:
+                break
+
+    def fetch_remaining_line_items(self, order_nodes):
+        # Orders whose lineItems connection has more pages
+        pending = [order_node for order_node in order_nodes
+                   if order_node.get("lineItems", {}).get("pageInfo", {}).get("hasNextPage")]
+
+        # Each aliased lookup costs roughly its page size, keep the batch under a single query's limit
+        batch_size = max(1, self.page_sizer.max_query_cost // (self.remaining_line_items_first + 3))
+
+        while pending:
+            batch = pending[:batch_size]
+            query = build_remaining_line_items_query(len(batch), self.remaining_line_items_first, self.line_item_fields)
+            variables = {}
+            for i, order_node in enumerate(batch):
+                variables[f"id{i}"] = order_node["id"]
+                variables[f"after{i}"] = order_node["lineItems"]["pageInfo"]["endCursor"]
+
+            data = self.execute(query, variables, len(batch) * (self.remaining_line_items_first + 3), self.scope)
+
+            still_pending = []
+            for i, order_node in enumerate(batch):
+                line_items = data["data"][f"fo{i}"]["lineItems"]
+                order_node["lineItems"]["nodes"].extend(line_items["nodes"])
+                order_node["lineItems"]["pageInfo"] = line_items["pageInfo"]
+                if line_items["pageInfo"]["hasNextPage"]:
+                    still_pending.append(order_node)
+
+            pending = still_pending + pending[batch_size:]
+
+
+bulk_operation_mutation = """
+    mutation RunBulkQuery($query: String!) {
+        bulkOperationRunQuery(query: $query) {
+            bulkOperation {
+                id
+                status
+            }
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+bulk_operation_status_query = """
+    query BulkOperationStatus($id: ID!) {
+        node(id: $id) {
+            ... on BulkOperation {
+                id
+                status
+                errorCode
+                objectCount
+                url
+            }
+        }
+    }
+"""
+
+# Shopify only runs one bulk query per shop at a time
+_bulk_operation_lock = threading.Lock()
+
+
+class BulkOperationError(Exception):
+    pass
+
+
+END_CURSOR_QUERY = """
+query FulfillmentOrderCursor($locationId: String!, $after: String, $first: Int!) {
+    fulfillmentOrders(first: $first, query: $locationId, includeClosed: true, after: $after) {
+        pageInfo {
+            endCursor
+            hasNextPage
+        }
+    }
+}
+"""
+
+
+def find_end_cursor(location_id, cursor=None, page_size=250, transport=None):
+    """
+    The cursor after a location's last fulfillment order, paging from cursor
+    with a query that selects nothing but pageInfo. Bulk exports have no
+    cursor of their own, so this is where the next paged run picks up.
+    """
+    execute = transport.execute if transport is not None else execute_graphql
+    while True:
+        data = execute(END_CURSOR_QUERY,
+                       {"locationId": f"assigned_location_id:{location_id}", "after": cursor, "first": page_size},
+                       page_size + 2, f"location {location_id}")
+        page_info = data["data"]["fulfillmentOrders"]["pageInfo"]
+        # An empty page has no endCursor; the previous one still stands
+        cursor = page_info["endCursor"] or cursor
+        if not page_info["hasNextPage"]:
+            return cursor
+
+
+NEXT_ORDER_QUERY = """
+query NextFulfillmentOrder($locationId: String!, $after: String) {
+    fulfillmentOrders(first: 1, query: $locationId, includeClosed: true, after: $after) {
+        nodes {
+            id
+        }
+    }
+}
+"""
+
+
+def find_next_order_id(location_id, cursor, transport=None):
+    """The id of the first fulfillment order after cursor, or None when there isn't one yet."""
+    execute = transport.execute if transport is not None else execute_graphql
+    data = execute(NEXT_ORDER_QUERY, {"locationId": f"assigned_location_id:{location_id}", "after": cursor},
+                   3, f"location {location_id}")
+    order_nodes = data["data"]["fulfillmentOrders"]["nodes"]
+    return order_nodes[0]["id"] if order_nodes else None
+
+
+def build_bulk_query(location_id, fulfillment_order_fields, line_item_fields, minimum_id=None):
+    """
+    Bulk queries can't take variables or pagination arguments, so the
+    location filter is written straight into the query text. minimum_id
+    (a numeric id) limits the export to fulfillment orders from that one on,
+    which is how a bulk run starts after a saved cursor.
+    """
+    search = f"assigned_location_id:{location_id}"
+    if minimum_id is not None:
+        search += f" AND id:>={minimum_id}"
+    return f"""
+    {{
+        fulfillmentOrders(query: "{search}", includeClosed: true) {{
+            edges {{
+                node {{{fulfillment_order_fields}
+                    lineItems {{
+                        edges {{
+                            node {{{line_item_fields}
+                            }}
+                        }}
+                    }}
+                }}
+            }}
+        }}
+    }}
+    """
+
+
+def run_bulk_query(query, poll_interval=2.0, timeout=3600.0):
+    """
+    Submit a bulkOperationRunQuery and poll it until it finishes.
+    Returns the URL of the JSONL result, or None when the query matched nothing.
+    """
+    with _bulk_operation_lock:
+        data = execute_graphql(bulk_operation_mutation, {"query": query}, 10, "bulk")
+        result = data["data"]["bulkOperationRunQuery"]
+        if result["userErrors"]:
+            raise BulkOperationError("; ".join(error["message"] for error in result["userErrors"]))
+
+        operation_id = result["bulkOperation"]["id"]
+        deadline = time.monotonic() + timeout
+        while True:
+            data = execute_graphql(bulk_operation_status_query, {"id": operation_id}, 1, "bulk")
+            operation = data["data"]["node"]
+            if operation["status"] == "COMPLETED":
+                return operation["url"]
+            if operation["status"] in ("FAILED", "CANCELED", "EXPIRED"):
+                raise BulkOperationError(f"Bulk operation {operation_id} {operation['status'].lower()}: {operation['errorCode']}")
+            if time.monotonic() > deadline:
+                raise BulkOperationError(f"Bulk operation {operation_id} did not finish within {timeout} seconds")
+            time.sleep(poll_interval)
+
+
+def iter_bulk_fulfillment_orders(lines):
+    """
+    Rebuild fulfillment orders from bulk JSONL lines. Line items come back as
+    separate records pointing at their order through __parentId, and Shopify
+    writes each parent before its children, so only the current order is held
+    in memory. Yields nodes shaped like the paged query's.
+    """
+    current_order = None
+    orphaned_records = 0
+
+    for line in lines:
+        if not line:
+            continue
+        record = json.loads(line)
+        parent_id = record.pop("__parentId", None)
+
+        if parent_id is None:
+            if current_order is not None:
+                yield current_order
+            record["lineItems"] = {"nodes": []}
+            current_order = record
+        elif current_order is not None and parent_id == current_order["id"]:
+            current_order["lineItems"]["nodes"].append(record)
+        else:
+            orphaned_records += 1
+
+    if current_order is not None:
+        yield current_order
+
+    if orphaned_records:
+        print(f"Skipped {orphaned_records} bulk records whose parent wasn't the preceding order.")
+
+
+def stream_bulk_results(url, batch_size=250):
+    """Download a bulk result file line by line and yield lists of up to batch_size order nodes."""
+    if url is None:
+        return
+
+    with get_transport().stream(url) as response:
+        batch = []
+        for order_node in iter_bulk_fulfillment_orders(response.iter_lines()):
+            batch.append(order_node)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
@@ -0,0 +1,102 @@
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+# SQLite's default limit on bound parameters in older builds
+_MAX_QUERY_PARAMETERS = 500
+
+
+class StateStore:
+    """
+    Durable run state in a local SQLite database (WAL mode):
+      - cursors: the fulfillmentOrders cursor each (vendor, location) has exported up to
+      - exported_orders: fulfillment orders already exported per vendor, so orders
+        that come back (the query includes closed orders) aren't exported twice
+    A vendor's cursor and exported orders are committed together, in one
+    transaction, once its file has been written.
+    read_only opens an existing database without creating or changing
+    anything, for dry runs.
+    """
+    def __init__(self, path="state.db", read_only=False):
+        self.path = path
+        self.lock = threading.Lock()
+        if read_only:
+            # A read-only connection to a WAL database still creates the -wal and -shm files. They
+            # only exist while another process has it open, so when they're missing nothing is
+            # writing to it and it can be opened as immutable, which creates nothing.
+            mode = "mode=ro" if os.path.exists(f"{path}-wal") else "immutable=1"
+            uri = f"{pathlib.Path(path).resolve().as_uri()}?{mode}"
+            self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            return
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS cursors (
+                    vendor TEXT NOT NULL,
+                    location_id TEXT NOT NULL,
+                    cursor TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (vendor, location_id)
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS exported_orders (
+                    vendor TEXT NOT NULL,
+                    fulfillment_order_id TEXT NOT NULL,
+                    exported_at REAL NOT NULL,
+                    PRIMARY KEY (vendor, fulfillment_order_id)
+                ) WITHOUT ROWID
+            """)
+
+    def get_cursor(self, vendor, location_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT cursor FROM cursors WHERE vendor = ? AND location_id = ?", (vendor, location_id)
+            ).fetchone()
+        return row[0] if row else None
+
+    def has_cursor(self, vendor, location_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM cursors WHERE vendor = ? AND location_id = ?", (vendor, location_id)
+            ).fetchone()
+        return row is not None
+
+    def exported_ids(self, vendor, fulfillment_order_ids):
+        """Returns the subset of fulfillment_order_ids already exported for this vendor."""
+        fulfillment_order_ids = list(fulfillment_order_ids)
+        exported = set()
+        with self.lock:
+            for start in range(0, len(fulfillment_order_ids), _MAX_QUERY_PARAMETERS):
+                chunk = fulfillment_order_ids[start:start + _MAX_QUERY_PARAMETERS]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT fulfillment_order_id FROM exported_orders "
+                    f"WHERE vendor = ? AND fulfillment_order_id IN ({placeholders})",
+                    [vendor, *chunk],
+                )
+                exported.update(row[0] for row in rows)
+        return exported
+
+    def commit_vendor(self, vendor, location_id, cursor, fulfillment_order_ids):
+        """Save the vendor's new cursor and the orders it just exported in one transaction."""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO cursors (vendor, location_id, cursor, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (vendor, location_id) DO UPDATE SET cursor = excluded.cursor, updated_at = excluded.updated_at",
+                (vendor, location_id, cursor, now),
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO exported_orders (vendor, fulfillment_order_id, exported_at) VALUES (?, ?, ?)",
+                ((vendor, fulfillment_order_id, now) for fulfillment_order_id in fulfillment_order_ids),
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
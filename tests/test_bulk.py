@@ -0,0 +1,86 @@
+"""Bulk exports: rebuilding JSONL results and resuming after a saved cursor."""
+import json
+
+import pytest
+
+import orderProcessing
+import shopify_module
+from fixture_server import FixtureServer
+from shopify_module import ShopifyRateBudget, ShopifyTransport, iter_bulk_fulfillment_orders
+
+VENDOR = {
+    "location_id": "1",
+    "vendor_name": "vendor1",
+    "output_filename": "filename1",
+    "columns_order": ["Order ID", "SKU Number"],
+    "mapping": {
+        "Order ID": {"path": "order.name", "level": "order"},
+        "SKU Number": {"path": "sku", "level": "line_item"},
+    },
+}
+
+
+def jsonl(*records):
+    return [json.dumps(record) for record in records]
+
+
+def test_line_items_are_put_back_under_their_order():
+    lines = jsonl({"id": "fo/1", "status": "OPEN"}, {"sku": "a", "__parentId": "fo/1"},
+                  {"sku": "b", "__parentId": "fo/1"}, {"id": "fo/2", "status": "OPEN"}) + [""]
+    orders = list(iter_bulk_fulfillment_orders(lines))
+
+    assert orders == [
+        {"id": "fo/1", "status": "OPEN", "lineItems": {"nodes": [{"sku": "a"}, {"sku": "b"}]}},
+        {"id": "fo/2", "status": "OPEN", "lineItems": {"nodes": []}},
+    ]
+
+
+def test_records_out_of_order_are_skipped_and_counted(capsys):
+    lines = jsonl({"sku": "before any order", "__parentId": "fo/1"}, {"id": "fo/1"},
+                  {"sku": "a", "__parentId": "fo/1"}, {"id": "fo/2"}, {"sku": "late", "__parentId": "fo/1"})
+    orders = list(iter_bulk_fulfillment_orders(lines))
+
+    assert [[item["sku"] for item in order["lineItems"]["nodes"]] for order in orders] == [["a"], []]
+    assert "Skipped 2 bulk records" in capsys.readouterr().out
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with FixtureServer(orders=30, items_per_order=3, long_order_every=7, long_order_items=40,
+                       restore_rate=1000, bulk_delay=0.0) as server:
+        # run_bulk_query and stream_bulk_results go through the process-wide transport
+        transport = ShopifyTransport(server.url, "test", budget=ShopifyRateBudget(restore_rate=1000))
+        monkeypatch.setattr(shopify_module, "_transport", transport)
+        yield server
+
+
+def bulk_fetch(cursor):
+    location_fetcher = orderProcessing.LocationFetcher("1", cursor, bulk=True)
+    formatter = orderProcessing.build_vendor_formatter(VENDOR)
+    location_fetcher.add_formatter(formatter, VENDOR)
+    location_fetcher.fetch_orders()
+    order_names = sorted({row["Order ID"] for row in formatter.flattened_data})
+    return order_names, location_fetcher.end_cursor
+
+
+def test_bulk_export_without_a_cursor_is_the_whole_history(server):
+    order_names, end_cursor = bulk_fetch(None)
+
+    assert order_names == sorted(order["order"]["name"] for order in server.orders)
+    # The cursor a paged run would have reached, saved for the next run
+    assert end_cursor == "30"
+
+
+def test_bulk_export_starts_after_the_saved_cursor(server):
+    order_names, end_cursor = bulk_fetch("23")
+
+    assert order_names == sorted(order["order"]["name"] for order in server.orders[23:])
+    assert end_cursor == "30"
+
+
+def test_bulk_export_with_nothing_new_starts_no_operation(server):
+    order_names, end_cursor = bulk_fetch("30")
+
+    assert order_names == []
+    assert end_cursor == "30"
+    assert server.bulk_operations == {}
@@ -0,0 +1,109 @@
+"""GmailMailer batching and per-vendor results against the fake Gmail server."""
+import base64
+import email
+import threading
+
+import pytest
+from google.auth.credentials import AnonymousCredentials
+
+from email_module import GmailMailer
+from fixture_server import FakeGmailServer
+
+
+@pytest.fixture
+def attachment(tmp_path):
+    def make_attachment(name, size=100):
+        path = tmp_path / name
+        path.write_bytes(b"x" * size)
+        return str(path)
+    return make_attachment
+
+
+def make_mailer(gmail, **options):
+    return GmailMailer(creds=AnonymousCredentials(), api_endpoint=gmail.url, **options)
+
+
+def queue(mailer, vendor, attachment_paths):
+    mailer.queue_draft(["orders@example.com"], f"Orders for {vendor}", "body", "<p>sig</p>", attachment_paths,
+                       [], vendor)
+
+
+def draft_subjects(gmail):
+    return [email.message_from_bytes(base64.urlsafe_b64decode(draft["message"]["raw"]))["subject"]
+            for draft in gmail.drafts if draft is not None]
+
+
+def test_drafts_are_batched_by_count(attachment):
+    with FakeGmailServer() as gmail:
+        mailer = make_mailer(gmail, batch_size=3)
+        for i in range(7):
+            queue(mailer, f"vendor{i}", attachment(f"vendor{i}.xlsx"))
+        results = mailer.flush()
+        mailer.close()
+
+    assert results == {f"vendor{i}": None for i in range(7)}
+    assert len(gmail.drafts) == 7
+    assert gmail.batch_count == 3
+
+
+def test_drafts_are_batched_by_bytes(attachment):
+    with FakeGmailServer() as gmail:
+        # Each draft is about 6.2 KB once encoded, so only two fit in 16 KB
+        mailer = make_mailer(gmail, batch_size=10, max_batch_bytes=16 * 1024)
+        for i in range(5):
+            queue(mailer, f"vendor{i}", attachment(f"vendor{i}.xlsx", size=3000))
+        results = mailer.flush()
+        mailer.close()
+
+    assert all(error is None for error in results.values())
+    assert len(gmail.drafts) == 5
+    assert gmail.batch_count == 3
+
+
+def test_failures_are_reported_per_vendor(attachment):
+    with FakeGmailServer(fail_every=2) as gmail:
+        mailer = make_mailer(gmail)
+        for vendor in ("vendor1", "vendor2", "vendor3", "vendor4"):
+            queue(mailer, vendor, attachment(f"{vendor}.xlsx"))
+        results = mailer.flush()
+        mailer.close()
+
+    assert [vendor for vendor, error in sorted(results.items()) if error is not None] == ["vendor2", "vendor4"]
+
+
+def test_vendor_with_several_drafts_keeps_its_first_failure(attachment):
+    with FakeGmailServer(fail_every=2) as gmail:
+        # 150 bytes per draft puts each 100 byte file in a draft of its own
+        mailer = make_mailer(gmail, max_attachment_bytes=150)
+        queue(mailer, "vendor1", [attachment(f"part{i}.csv") for i in range(3)])
+        results = mailer.flush()
+        mailer.close()
+
+    # The second draft failed; the third succeeding doesn't clear it
+    assert results["vendor1"] is not None
+    assert "Invalid draft" in str(results["vendor1"])
+    assert draft_subjects(gmail) == ["Orders for vendor1 (1 of 3)", "Orders for vendor1 (3 of 3)"]
+
+
+def test_flush_for_some_vendors_leaves_the_others(attachment):
+    with FakeGmailServer(latency=1.0, fail_every=2) as gmail:
+        mailer = make_mailer(gmail, batch_size=1)
+        results = {}
+
+        def run(vendor):
+            queue(mailer, vendor, attachment(f"{vendor}.xlsx"))
+            results[vendor] = mailer.flush([vendor])
+
+        threads = [threading.Thread(target=run, args=(vendor,)) for vendor in ("vendor1", "vendor2")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        leftover = mailer.flush()
+        mailer.close()
+
+    # Each run gets back only its own vendor, whichever batch finished first
+    assert [list(vendor_results) for vendor, vendor_results in sorted(results.items())] == [["vendor1"], ["vendor2"]]
+    assert sum(vendor_results[vendor] is not None for vendor, vendor_results in results.items()) == 1
+    # Flushed results are forgotten
+    assert leftover == {}
@@ -0,0 +1,85 @@
+"""The columnar mapping engine against the dict engine, on messy pages."""
+import orderProcessing
+from mapping_module import PageFrames
+
+VENDOR = {
+    "location_id": "1",
+    "vendor_name": "vendor1",
+    "output_filename": "filename1",
+    "columns_order": ["PO Number", "Order Name", "Email", "Ship City", "SKU Number", "Quantity", "Customer ID",
+                      "Ship Via", "Notes"],
+    "mapping": {
+        "Order Name": {"path": "order.name", "level": "order"},
+        "Email": {"path": "order.customer.email", "level": "order"},
+        "Ship City": {"path": "order.shippingAddress.city", "level": "order"},
+        "SKU Number": {"path": "sku", "level": "line_item"},
+        "Quantity": {"path": "totalQuantity", "level": "line_item"},
+        "Ship Via": {"level": "static", "value": "FedEx"},
+    },
+    "defaults": {"Notes": "none"},
+}
+
+ORDER_NODES = [
+    {
+        "id": "gid://shopify/FulfillmentOrder/1",
+        "order": {"id": "gid://shopify/Order/11", "name": "#1001", "customer": {"id": "gid://shopify/Customer/21",
+                                                                                  "email": "a@example.com"},
+                  "shippingAddress": {"city": "Springfield"}},
+        "lineItems": {"nodes": [
+            {"sku": "shipped", "totalQuantity": 1, "requiresShipping": True},
+            {"sku": "null means digital", "totalQuantity": 1, "requiresShipping": None},
+            {"sku": "missing means shipped", "totalQuantity": 2},
+            {"sku": "digital", "totalQuantity": 1, "requiresShipping": False},
+            {"totalQuantity": 3, "requiresShipping": True},
+            {"sku": None, "totalQuantity": None, "requiresShipping": True},
+        ]},
+    },
+    # No customer, no shipping address and no order id
+    {
+        "id": "gid://shopify/FulfillmentOrder/2",
+        "order": {"name": "#1002", "customer": None},
+        "lineItems": {"nodes": [{"sku": "no customer", "totalQuantity": 1}]},
+    },
+    # No order at all
+    {
+        "id": "gid://shopify/FulfillmentOrder/3",
+        "order": None,
+        "lineItems": {"nodes": [{"sku": "no order", "totalQuantity": 1, "requiresShipping": True}]},
+    },
+    # Orders without line items add no rows
+    {"id": "gid://shopify/FulfillmentOrder/4", "order": {"id": "gid://shopify/Order/14"}, "lineItems": {"nodes": []}},
+    {"id": "gid://shopify/FulfillmentOrder/5", "order": {"id": "gid://shopify/Order/15"}},
+    # Only digital items
+    {
+        "id": "gid://shopify/FulfillmentOrder/6",
+        "order": {"id": "gid://shopify/Order/16", "name": "#1006"},
+        "lineItems": {"nodes": [{"sku": "digital only", "requiresShipping": None}]},
+    },
+]
+
+
+def dict_engine_rows(order_nodes):
+    formatter = orderProcessing.build_vendor_formatter(VENDOR)
+    formatter.process_orders(order_nodes)
+    return [[row.get(column) for column in VENDOR["columns_order"]] for row in formatter.flattened_data]
+
+
+def columnar_engine_rows(order_nodes):
+    formatter = orderProcessing.build_vendor_formatter(VENDOR)
+    formatter.process_frames(PageFrames(order_nodes, formatter.order_paths, formatter.line_item_paths), order_nodes)
+    return [list(row) for frame in formatter.frames for row in frame.itertuples(index=False, name=None)]
+
+
+def test_engines_agree_on_null_missing_and_partial_fields():
+    rows = dict_engine_rows(ORDER_NODES)
+
+    assert [row[4] for row in rows] == ["shipped", "missing means shipped", None, None, "no customer", "no order"]
+    assert columnar_engine_rows(ORDER_NODES) == rows
+
+
+def test_engines_agree_on_a_page_of_explicit_nulls():
+    order_nodes = [{"id": "gid://shopify/FulfillmentOrder/7", "order": {"id": "gid://shopify/Order/17"},
+                    "lineItems": {"nodes": [{"sku": "a", "requiresShipping": None},
+                                            {"sku": "b", "requiresShipping": None}]}}]
+
+    assert dict_engine_rows(order_nodes) == columnar_engine_rows(order_nodes) == []
@@ -0,0 +1,49 @@
+"""Per-cycle metrics for the resident service."""
+from collections import deque
+
+from metrics_module import Profiler, RunMetrics
+from shopify_module import LATENCY_WINDOW, ShopifyTransport
+
+
+def test_take_reports_only_its_scopes_and_keeps_the_totals():
+    metrics = RunMetrics()
+    metrics.increment("pages", 3, scope="location 1")
+    metrics.increment("pages", 5, scope="location 2")
+    metrics.observe("fetch", 2.0, scope="location 1")
+
+    cycle = metrics.take(["location 1"])
+    assert list(cycle["scopes"]) == ["location 1"]
+    assert cycle["scopes"]["location 1"]["counters"] == {"pages": 3}
+
+    # The next cycle starts from nothing, but the totals still count both
+    metrics.increment("pages", 2, scope="location 1")
+    metrics.observe("fetch", 1.0, scope="location 1")
+    assert metrics.take(["location 1"])["scopes"]["location 1"]["counters"] == {"pages": 2}
+    stages, counters, gauges = metrics.totals()
+    assert counters == {("location 1", "pages"): 5, ("location 2", "pages"): 5}
+    assert stages[("location 1", "fetch")] == [2, 3.0, 2.0]
+    assert list(metrics.report()["scopes"]) == ["location 2"]
+
+
+def test_latency_stats_per_scope_in_a_bounded_window():
+    transport = ShopifyTransport("http://127.0.0.1:9/", "test")
+    for i in range(LATENCY_WINDOW + 5):
+        transport.record_latency(0.1, "location 1")
+    transport.record_latency(0.5, "location 2")
+    transport.record_retry(throttled=True, scope="location 2")
+
+    assert isinstance(transport.scope_stats["location 1"][2], deque)
+    assert transport.latency_stats("location 1")["requests"] == LATENCY_WINDOW
+    assert transport.latency_stats("location 2", reset=True)["throttled"] == 1
+    assert transport.latency_stats("location 2") == {"requests": 0, "retries": 0, "throttled": 0}
+    # The transport's own totals aren't reset
+    assert transport.throttled == 1
+
+
+def test_profile_is_saved_even_when_its_folder_does_not_exist_yet(tmp_path, capsys):
+    # A dry run, or a run with no new orders, never creates the day's output folder
+    output_path = tmp_path / "2024" / "03 - March" / "profile"
+    with Profiler("cprofile", str(output_path)):
+        sum(range(1000))
+
+    assert (tmp_path / "2024" / "03 - March" / "profile.prof").exists()
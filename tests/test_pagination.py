@@ -0,0 +1,99 @@
+"""FulfillmentOrderPager and PageSizer against the local fixture server."""
+from fixture_server import FixtureServer
+from shopify_module import (FulfillmentOrderPager, PageSizer, ShopifyRateBudget, ShopifyTransport,
+                            build_fulfillment_orders_query, find_end_cursor)
+
+ORDER_PATHS = frozenset({"id", "order.name"})
+LINE_ITEM_PATHS = frozenset({"sku", "requiresShipping"})
+
+
+def make_pager(server, page_sizer=None):
+    # A budget of its own per test, refilled as fast as the fixture's bucket
+    transport = ShopifyTransport(server.url, "test", budget=ShopifyRateBudget(restore_rate=server.bucket.restore_rate))
+    query, fulfillment_order_fields, line_item_fields = build_fulfillment_orders_query(ORDER_PATHS, LINE_ITEM_PATHS)
+    return FulfillmentOrderPager("1", query, line_item_fields, page_sizer=page_sizer, transport=transport)
+
+
+def test_every_line_item_is_returned_including_long_orders():
+    with FixtureServer(orders=40, items_per_order=3, long_order_every=7, long_order_items=130,
+                       restore_rate=1000) as server:
+        pages = list(make_pager(server).pages())
+
+    order_nodes = [order_node for page, end_cursor, has_next_page in pages for order_node in page]
+    assert [order_node["id"] for order_node in order_nodes] == [order["id"] for order in server.orders]
+    for order_node, order in zip(order_nodes, server.orders):
+        assert [item["sku"] for item in order_node["lineItems"]["nodes"]] == [item["sku"] for item in order["lineItems"]]
+
+    # Orders past the first 25 line items had to be finished with the follow-up query
+    assert sum(len(order_node["lineItems"]["nodes"]) > 25 for order_node in order_nodes) == 5
+    assert pages[-1][2] is False
+    assert all(has_next_page for page, end_cursor, has_next_page in pages[:-1])
+
+
+def test_pages_resume_after_a_cursor():
+    with FixtureServer(orders=30, restore_rate=1000) as server:
+        pages = list(make_pager(server).pages())
+        resumed = list(make_pager(server).pages(pages[0][1]))
+
+    resumed_ids = [order_node["id"] for page, end_cursor, has_next_page in resumed for order_node in page]
+    assert resumed_ids == [order["id"] for order in server.orders[len(pages[0][0]):]]
+
+
+def test_end_cursor_is_where_paging_resumes():
+    # What a bulk export saves, so the next paged run only sees orders created since
+    with FixtureServer(orders=30, restore_rate=1000) as server:
+        pager = make_pager(server)
+        end_cursor = find_end_cursor("1", page_size=7, transport=ShopifyTransport(server.url, "test"))
+        assert end_cursor == list(pager.pages())[-1][1]
+        # Nothing new yet: the cursor stays where it was
+        assert find_end_cursor("1", end_cursor, transport=ShopifyTransport(server.url, "test")) == end_cursor
+
+        server.add_orders(4)
+        resumed = list(make_pager(server).pages(end_cursor))
+
+    assert [order_node["id"] for page, cursor, has_next_page in resumed for order_node in page] == \
+        [order["id"] for order in server.orders[30:]]
+
+
+def test_page_size_grows_from_the_reported_cost():
+    page_sizer = PageSizer(first=5)
+    # A bucket too big to run low, so only the single-query limit caps the page size
+    with FixtureServer(orders=200, items_per_order=3, maximum_available=10 ** 6, restore_rate=10 ** 6) as server:
+        page_sizes = [len(page) for page, end_cursor, has_next_page in make_pager(server, page_sizer).pages()]
+
+    # A page of 20 is reported at 2 + 20 * (3 + 25); the next one fills 90% of the 1000-point limit
+    largest_page = int(1000 * 0.9 // ((2 + 20 * 28) / 20))
+    assert page_sizes[:5] == [5, 10, 20, largest_page, largest_page]
+    assert sum(page_sizes) == 200
+
+
+def test_page_size_shrinks_when_the_fixture_bucket_runs_low():
+    page_sizer = PageSizer(first=20)
+    with FixtureServer(orders=100, items_per_order=3, maximum_available=600, restore_rate=100) as server:
+        page_sizes = [len(page) for page, end_cursor, has_next_page in make_pager(server, page_sizer).pages()]
+
+    assert page_sizes[0] == 20
+    assert min(page_sizes[1:-1]) < 20
+    assert sum(page_sizes) == 100
+
+
+def test_page_size_shrinks_when_the_bucket_runs_low():
+    page_sizer = PageSizer(first=20)
+    cost = {"requestedQueryCost": 20 * 28, "throttleStatus": {"currentlyAvailable": 1000, "restoreRate": 50}}
+    assert page_sizer.update(cost) == 32
+
+    # Little left in the bucket: the next page only asks for what's available
+    cost = {"requestedQueryCost": 32 * 28, "throttleStatus": {"currentlyAvailable": 150, "restoreRate": 50}}
+    assert page_sizer.update(cost) == 4
+    assert page_sizer.estimated_cost() == 28 * 5
+
+    # And never below the minimum
+    cost = {"requestedQueryCost": 4 * 28, "throttleStatus": {"currentlyAvailable": 0, "restoreRate": 50}}
+    assert page_sizer.update(cost) == 1
+
+
+def test_page_size_is_unchanged_without_cost_information():
+    page_sizer = PageSizer(first=7)
+    assert page_sizer.update(None) == 7
+    assert page_sizer.update({}) == 7
+    assert page_sizer.estimated_cost() == 150
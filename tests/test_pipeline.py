@@ -0,0 +1,79 @@
+"""run_vendor_pipelines: fetching once per location and finishing vendors in parallel."""
+import threading
+
+import pytest
+
+import orderProcessing
+import shopify_module
+from fixture_server import FixtureServer
+from shopify_module import ShopifyRateBudget, ShopifyTransport
+
+
+def make_vendor(vendor_name):
+    return {
+        "location_id": "1",
+        "vendor_name": vendor_name,
+        "output_filename": f"{vendor_name}_orders",
+        "email_addresses": [],
+        "columns_order": ["Order ID", "SKU Number"],
+        "mapping": {
+            "Order ID": {"path": "order.name", "level": "order"},
+            "SKU Number": {"path": "sku", "level": "line_item"},
+        },
+    }
+
+
+class RecordingMailer:
+    def __init__(self):
+        self.vendors = []
+
+    def queue_draft(self, to_email, subject, body, signature, attachment_paths, cc_emails, vendor):
+        self.vendors.append(vendor)
+
+    def flush(self, vendors=None):
+        return {vendor: None for vendor in self.vendors}
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    with FixtureServer(orders=10, restore_rate=1000) as server:
+        transport = ShopifyTransport(server.url, "test", budget=ShopifyRateBudget(restore_rate=1000))
+        monkeypatch.setattr(shopify_module, "_transport", transport)
+        yield server
+
+
+def test_vendors_at_one_location_are_written_at_the_same_time(server, monkeypatch):
+    vendor2_writing = threading.Event()
+    write_output = orderProcessing.VendorFormatter.write_output
+
+    def slow_write_output(self, *args):
+        if self.vendor_name == "vendor1":
+            # Only finishes once vendor2 has started writing, which can't happen if they're written in turn
+            assert vendor2_writing.wait(5)
+        else:
+            vendor2_writing.set()
+        return write_output(self, *args)
+
+    monkeypatch.setattr(orderProcessing.VendorFormatter, "write_output", slow_write_output)
+    location_fetchers = orderProcessing.plan_location_fetches([make_vendor("vendor1"), make_vendor("vendor2")])
+    mailer = RecordingMailer()
+    results = orderProcessing.run_vendor_pipelines(location_fetchers, mailer, max_workers=2)
+
+    assert len(location_fetchers) == 1
+    assert [(result["vendor"], result["status"], result["rows"]) for result in results] == \
+        [("vendor1", "ok", 30), ("vendor2", "ok", 30)]
+    assert sorted(mailer.vendors) == ["vendor1", "vendor2"]
+    assert server.request_count == 2
+
+
+def test_a_failed_fetch_fails_every_vendor_at_the_location(server, monkeypatch):
+    def failing_fetch(self):
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(orderProcessing.LocationFetcher, "fetch_orders", failing_fetch)
+    location_fetchers = orderProcessing.plan_location_fetches([make_vendor("vendor1"), make_vendor("vendor2")])
+    results = orderProcessing.run_vendor_pipelines(location_fetchers, RecordingMailer())
+
+    assert [(result["vendor"], result["status"], result["error"]) for result in results] == \
+        [("vendor1", "failed", "fetch: connection reset"), ("vendor2", "failed", "fetch: connection reset")]
@@ -0,0 +1,148 @@
+"""StateStore cursors and exported orders, and how the pipeline uses them."""
+import sqlite3
+
+import pytest
+
+import orderProcessing
+import shopify_module
+from fixture_server import FixtureServer, generate_fulfillment_order
+from shopify_module import ShopifyRateBudget, ShopifyTransport
+from state_module import StateStore
+
+
+def make_vendor(vendor_name, location_id="1"):
+    return {
+        "location_id": location_id,
+        "vendor_name": vendor_name,
+        "output_filename": f"{vendor_name}_orders",
+        "email_addresses": [],
+        "columns_order": ["Order ID", "SKU Number"],
+        "mapping": {
+            "Order ID": {"path": "order.name", "level": "order"},
+            "SKU Number": {"path": "sku", "level": "line_item"},
+        },
+    }
+
+
+def order_node(index):
+    order = generate_fulfillment_order(index, items_per_order=2)
+    return dict(order, lineItems={"nodes": order["lineItems"]})
+
+
+@pytest.fixture
+def state_store(tmp_path, monkeypatch):
+    # lastRun_*.txt files are read from the working directory
+    monkeypatch.chdir(tmp_path)
+    state_store = StateStore(str(tmp_path / "state.db"))
+    yield state_store
+    state_store.close()
+
+
+def test_exported_orders_are_skipped_before_mapping(state_store, monkeypatch):
+    order_nodes = [order_node(i) for i in range(4)]
+    state_store.commit_vendor("vendor1", "1", "2", [order_nodes[0]["id"], order_nodes[1]["id"]])
+    formatter = orderProcessing.build_vendor_formatter(make_vendor("vendor1"), state_store)
+
+    mapped = []
+    map_vendor_data = formatter.map_vendor_data
+    monkeypatch.setattr(formatter, "map_vendor_data",
+                        lambda node: mapped.append(node["id"]) or map_vendor_data(node))
+    formatter.process_orders(order_nodes)
+
+    assert mapped == [order_nodes[2]["id"], order_nodes[3]["id"]]
+    assert formatter.exported_order_ids == mapped
+    assert formatter.row_count() == 4
+    # Another vendor hasn't been sent them
+    assert state_store.exported_ids("vendor2", [order_nodes[0]["id"]]) == set()
+
+
+def test_cursor_and_orders_are_committed_together(state_store):
+    state_store.commit_vendor("vendor1", "1", "5", ["fo/1"])
+
+    def failing_ids():
+        yield "fo/2"
+        raise RuntimeError("disk full")
+
+    with pytest.raises(RuntimeError):
+        state_store.commit_vendor("vendor1", "1", "9", failing_ids())
+
+    # Neither the cursor nor the first of the new orders was saved
+    assert state_store.get_cursor("vendor1", "1") == "5"
+    assert state_store.exported_ids("vendor1", ["fo/1", "fo/2"]) == {"fo/1"}
+
+
+class RecordingMailer:
+    def queue_draft(self, *args):
+        pass
+
+    def flush(self, vendors=None):
+        return {}
+
+
+def test_cursor_is_only_saved_once_the_file_is_written(state_store, monkeypatch):
+    state_store.commit_vendor("vendor1", "1", "3", [])
+    state_store.commit_vendor("vendor2", "1", "3", [])
+    write_output = orderProcessing.VendorFormatter.write_output
+
+    def failing_write_output(self, *args):
+        if self.vendor_name == "vendor1":
+            raise OSError("No space left on device")
+        return write_output(self, *args)
+
+    monkeypatch.setattr(orderProcessing.VendorFormatter, "write_output", failing_write_output)
+    with FixtureServer(orders=10, restore_rate=1000) as server:
+        monkeypatch.setattr(shopify_module, "_transport",
+                            ShopifyTransport(server.url, "test", budget=ShopifyRateBudget(restore_rate=1000)))
+        location_fetchers = orderProcessing.plan_location_fetches([make_vendor("vendor1"), make_vendor("vendor2")],
+                                                                  state_store)
+        results = orderProcessing.run_vendor_pipelines(location_fetchers, RecordingMailer())
+
+    assert [result["status"] for result in results] == ["failed", "ok"]
+    exported = [order["id"] for order in server.orders[3:]]
+    assert (state_store.get_cursor("vendor1", "1"), state_store.exported_ids("vendor1", exported)) == ("3", set())
+    assert (state_store.get_cursor("vendor2", "1"), state_store.exported_ids("vendor2", exported)) == \
+        ("10", set(exported))
+
+
+def test_vendors_with_different_cursors_are_fetched_separately(state_store):
+    state_store.commit_vendor("vendor1", "1", "5", [])
+    state_store.commit_vendor("vendor2", "1", "5", [])
+    state_store.commit_vendor("vendor3", "1", "8", [])
+    vendors = [make_vendor("vendor1"), make_vendor("vendor2"), make_vendor("vendor3"), make_vendor("vendor4", "2")]
+
+    location_fetchers = orderProcessing.plan_location_fetches(vendors, state_store)
+
+    assert [(location_fetcher.location_id, location_fetcher.start_cursor,
+             [vendor_details["vendor_name"] for vendor_details, formatter in location_fetcher.vendors])
+            for location_fetcher in location_fetchers] == [
+        ("1", "5", ["vendor1", "vendor2"]),
+        ("1", "8", ["vendor3"]),
+        ("2", None, ["vendor4"]),
+    ]
+
+
+def test_last_run_file_is_only_used_for_vendors_the_store_has_not_seen(state_store, tmp_path):
+    (tmp_path / "lastRun_1.txt").write_text("7\n")
+    state_store.commit_vendor("vendor1", "1", "12", [])
+    # A vendor whose first export started from the beginning has a cursor of None, not "never seen"
+    state_store.commit_vendor("vendor2", "1", None, [])
+
+    assert orderProcessing.load_cursor(state_store, "vendor1", "1") == "12"
+    assert orderProcessing.load_cursor(state_store, "vendor2", "1") is None
+    assert orderProcessing.load_cursor(state_store, "vendor3", "1") == "7"
+    assert orderProcessing.load_cursor(state_store, "vendor3", "2") is None
+
+
+def test_read_only_store_reads_cursors_and_creates_no_files(state_store, tmp_path):
+    state_store.commit_vendor("vendor1", "1", "12", ["fo/1"])
+    state_store.close()
+    files_before = sorted(path.name for path in tmp_path.iterdir())
+
+    read_only_store = StateStore(str(tmp_path / "state.db"), read_only=True)
+    assert read_only_store.get_cursor("vendor1", "1") == "12"
+    assert read_only_store.exported_ids("vendor1", ["fo/1", "fo/2"]) == {"fo/1"}
+    with pytest.raises(sqlite3.OperationalError):
+        read_only_store.commit_vendor("vendor1", "1", "13", [])
+    read_only_store.close()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == files_before
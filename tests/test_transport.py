@@ -0,0 +1,89 @@
+"""ShopifyTransport retries against a fixture server that throttles and stalls."""
+import time
+
+import pytest
+
+from fixture_server import FixtureServer
+from metrics_module import metrics
+from shopify_module import (FulfillmentOrderPager, ShopifyError, ShopifyRateBudget, ShopifyTransport,
+                            build_fulfillment_orders_query)
+
+QUERY, FULFILLMENT_ORDER_FIELDS, LINE_ITEM_FIELDS = build_fulfillment_orders_query(
+    frozenset({"id", "order.name"}), frozenset({"sku", "requiresShipping"}))
+
+
+def page_variables(first=3):
+    return {"locationId": "assigned_location_id:1", "after": None, "first": first, "lineItemsFirst": 25}
+
+
+def make_transport(server, **options):
+    # The local budget starts out generous so the server's bucket is the one doing the throttling
+    budget = ShopifyRateBudget(maximum_available=10 ** 6, restore_rate=10 ** 6)
+    return ShopifyTransport(server.url, "test", budget=budget, **options)
+
+
+def test_http_429_waits_for_retry_after():
+    with FixtureServer(orders=10, restore_rate=1000, throttle_every=2, retry_after=1) as server:
+        transport = make_transport(server)
+        transport.execute(QUERY, page_variables())
+        start_time = time.monotonic()
+        data = transport.execute(QUERY, page_variables())
+        elapsed = time.monotonic() - start_time
+
+    assert len(data["data"]["fulfillmentOrders"]["nodes"]) == 3
+    assert server.request_count == 3
+    assert (transport.retries, transport.throttled) == (1, 1)
+    assert elapsed >= 1.0
+
+
+def test_graphql_throttled_waits_for_the_bucket_to_restore():
+    # A page of 10 requests 282 points but uses 62, so the second page finds 238 of 300 left
+    with FixtureServer(orders=30, maximum_available=300, restore_rate=100) as server:
+        transport = make_transport(server)
+        transport.execute(QUERY, page_variables(first=10), scope="throttled test")
+        start_time = time.monotonic()
+        data = transport.execute(QUERY, page_variables(first=10), scope="throttled test")
+        elapsed = time.monotonic() - start_time
+
+    assert len(data["data"]["fulfillmentOrders"]["nodes"]) == 10
+    assert transport.throttled == 1
+    # (282 - 238) / 100 = 0.44s from requestedQueryCost and restoreRate, not a fixed backoff
+    assert 0.3 <= elapsed < 2.0
+    # And the local budget has taken on the server's bucket
+    assert (transport.budget.maximum_available, transport.budget.restore_rate) == (300, 100)
+    # Only the two queries that ran are counted and charged, at what they actually cost
+    counters = metrics.take(["throttled test"])["scopes"]["throttled test"]["counters"]
+    assert (counters["graphql_requests"], counters["graphql_throttled"], counters["graphql_query_cost"]) == (2, 1, 124)
+
+
+def test_retries_give_up_with_shopify_error():
+    with FixtureServer(orders=10, restore_rate=1000, throttle_every=1, retry_after=0) as server:
+        transport = make_transport(server, max_retries=2)
+        with pytest.raises(ShopifyError, match="HTTP 429 after 3 attempts"):
+            transport.execute(QUERY, page_variables())
+
+    assert server.request_count == 3
+    assert transport.throttled == 2
+
+
+def test_slow_responses_time_out_and_are_retried():
+    with FixtureServer(orders=10, restore_rate=1000, latency=1.0) as server:
+        transport = make_transport(server, timeout=(1, 0.2), max_retries=1, backoff_base=0.01)
+        with pytest.raises(ShopifyError, match="failed after 2 attempts"):
+            transport.execute(QUERY, page_variables())
+
+    assert transport.retries == 1
+    assert transport.latency_stats()["requests"] == 2
+
+
+def test_paging_survives_throttles_with_every_line_item():
+    # 864 line items, a third of the orders past the 25 fetched with the page
+    with FixtureServer(orders=72, items_per_order=3, long_order_every=3, long_order_items=30,
+                       restore_rate=1000, throttle_every=4, retry_after=0) as server:
+        transport = make_transport(server)
+        pager = FulfillmentOrderPager("1", QUERY, LINE_ITEM_FIELDS, transport=transport)
+        order_nodes = [order_node for page, end_cursor, has_next_page in pager.pages() for order_node in page]
+
+    assert (server.request_count, transport.throttled) == (13, 3)
+    assert len(order_nodes) == 72
+    assert sum(len(order_node["lineItems"]["nodes"]) for order_node in order_nodes) == 864
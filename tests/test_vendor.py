@@ -0,0 +1,35 @@
+"""Vendor validation of output formats."""
+import pytest
+
+import orderProcessing
+import writer_module
+from vendor_module import validate_vendor
+
+VENDOR = {
+    "location_id": "1",
+    "vendor_name": "vendor1",
+    "output_filename": "filename1",
+    "columns_order": ["SKU Number"],
+    "mapping": {"SKU Number": {"path": "sku", "level": "line_item"}},
+}
+
+
+@pytest.fixture
+def parquet_unavailable(monkeypatch):
+    monkeypatch.setitem(writer_module.FORMAT_DEPENDENCIES, "parquet", "not_an_installed_package")
+
+
+def test_unknown_output_format_is_a_problem():
+    assert validate_vendor(dict(VENDOR, output_format="pdf")) == ["'output_format' should be one of xlsx, csv, csv.gz, parquet"]
+
+
+def test_parquet_without_its_package_is_a_problem(parquet_unavailable):
+    problems = validate_vendor(dict(VENDOR, archive_format="parquet"))
+    assert problems == ["'archive_format': The parquet output format needs not_an_installed_package "
+                        "(pip install not_an_installed_package)"]
+
+
+def test_parquet_without_its_package_fails_before_fetching(parquet_unavailable):
+    # Plans loaded from the cache skip validate_vendor, so the formatter checks again
+    with pytest.raises(RuntimeError, match="used by vendor1"):
+        orderProcessing.build_vendor_formatter(dict(VENDOR, output_format="parquet"))
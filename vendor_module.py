@@ -0,0 +1,220 @@
+"""
+Vendor definitions, loaded from a directory with one JSON or YAML file per
+vendor (YAML needs PyYAML, which is only imported when a .yaml file exists):
+
+    {
+        "location_id": "00000000000",
+        "vendor_name": "vendor1",
+        "output_filename": "filename1",
+        "email_addresses": ["example@example.com"],
+        "columns_order": ["Order ID", "SKU Number", "Ship Via"],
+        "mapping": {
+            "Order ID": {"path": "order.name", "level": "order"},
+            "SKU Number": {"path": "sku", "level": "line_item"},
+            "Ship Via": {"level": "static", "value": "FedEx"}
+        },
+        "defaults": {}
+    }
+
+The optional keys are described at OPTIONAL_KEYS. A column is either mapped or
+given a default, never both, so the two can't drift apart.
+
+Each file is validated and compiled into an execution plan (see
+mapping_module.compile_vendor_plan), and the result is cached in one JSON file
+keyed by a hash of the file's contents. Unchanged files are neither parsed
+nor validated again, so startup stays quick with hundreds of vendors.
+"""
+import hashlib
+import json
+import os
+
+from mapping_module import compile_vendor_plan
+from metrics_module import write_atomically
+from writer_module import OUTPUT_FORMATS, missing_dependency_message
+
+# Bump when validation or compile_vendor_plan changes, so cached plans are rebuilt
+PLAN_VERSION = 1
+
+VENDOR_FILE_EXTENSIONS = (".json", ".yaml", ".yml")
+REQUIRED_KEYS = ("location_id", "vendor_name", "output_filename", "columns_order", "mapping")
+# email_addresses: the draft's recipients
+# defaults: values for columns the mapping doesn't fill
+# output_format: the emailed file, "xlsx" (default), "csv", "csv.gz" or "parquet"
+# archive_format: a copy written next to it but not emailed, e.g. "parquet"
+# max_rows_per_file, max_bytes_per_file: split the emailed file into parts past these
+#   (xlsx and csv files are kept under 17 MB, and xlsx under Excel's row limit, by default)
+# poll_interval: seconds between cycles in serve mode
+OPTIONAL_KEYS = ("email_addresses", "defaults", "output_format", "archive_format", "max_rows_per_file",
+                 "max_bytes_per_file", "poll_interval")
+MAPPING_LEVELS = ("order", "line_item", "static")
+
+
+class VendorConfigError(Exception):
+    pass
+
+
+def is_string_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def is_positive_number(value, integer=False):
+    number_types = int if integer else (int, float)
+    return isinstance(value, number_types) and not isinstance(value, bool) and value > 0
+
+
+def validate_vendor(vendor_details):
+    """Check a vendor definition against the schema. Returns a list of problems, empty when it's valid."""
+    if not isinstance(vendor_details, dict):
+        return ["expected an object with the vendor's settings"]
+
+    problems = [f"unknown key {key!r}" for key in vendor_details if key not in REQUIRED_KEYS + OPTIONAL_KEYS]
+    problems += [f"missing {key!r}" for key in REQUIRED_KEYS if key not in vendor_details]
+
+    for key in ("location_id", "vendor_name", "output_filename"):
+        if key in vendor_details and not (isinstance(vendor_details[key], str) and vendor_details[key]):
+            problems.append(f"{key!r} should be a non-empty string")
+    if "email_addresses" in vendor_details and not is_string_list(vendor_details["email_addresses"]):
+        problems.append("'email_addresses' should be a list of strings")
+
+    columns_order = vendor_details.get("columns_order", [])
+    if not (is_string_list(columns_order) and columns_order):
+        if "columns_order" in vendor_details:
+            problems.append("'columns_order' should be a non-empty list of strings")
+        columns_order = []
+    else:
+        duplicate_columns = sorted({column for column in columns_order if columns_order.count(column) > 1})
+        if duplicate_columns:
+            problems.append(f"columns listed twice in 'columns_order': {duplicate_columns}")
+
+    mapping = vendor_details.get("mapping", {})
+    if not isinstance(mapping, dict):
+        problems.append("'mapping' should be an object of column: {path, level}")
+        mapping = {}
+    for column_name, details in mapping.items():
+        prefix = f"mapping[{column_name!r}]"
+        if column_name not in columns_order:
+            problems.append(f"{prefix} isn't in 'columns_order'")
+        if not isinstance(details, dict):
+            problems.append(f"{prefix} should be an object with a level")
+            continue
+
+        level = details.get("level")
+        allowed_keys = ("level", "value", "path") if level == "static" else ("level", "path")
+        problems += [f"{prefix} has an unknown key {key!r}" for key in details if key not in allowed_keys]
+        if level not in MAPPING_LEVELS:
+            problems.append(f"{prefix} level should be one of {', '.join(MAPPING_LEVELS)}")
+        elif level == "static":
+            if "value" not in details:
+                problems.append(f"{prefix} is static but has no 'value'")
+        elif not (isinstance(details.get("path"), str) and details["path"]):
+            problems.append(f"{prefix} needs a 'path', e.g. order.name or sku")
+
+    defaults = vendor_details.get("defaults", {})
+    if not isinstance(defaults, dict):
+        problems.append("'defaults' should be an object of column: value")
+        defaults = {}
+    for column_name in defaults:
+        if column_name in mapping:
+            problems.append(f"defaults[{column_name!r}] is also in 'mapping'; set the column in one place")
+        elif column_name not in columns_order:
+            problems.append(f"defaults[{column_name!r}] isn't in 'columns_order'")
+
+    for key in ("output_format", "archive_format"):
+        if key in vendor_details and vendor_details[key] not in OUTPUT_FORMATS:
+            problems.append(f"{key!r} should be one of {', '.join(OUTPUT_FORMATS)}")
+        elif key in vendor_details and missing_dependency_message(vendor_details[key]):
+            problems.append(f"{key!r}: {missing_dependency_message(vendor_details[key])}")
+    for key in ("max_rows_per_file", "max_bytes_per_file"):
+        if key in vendor_details and not is_positive_number(vendor_details[key], integer=True):
+            problems.append(f"{key!r} should be a positive whole number")
+    if "poll_interval" in vendor_details and not is_positive_number(vendor_details["poll_interval"]):
+        problems.append("'poll_interval' should be a positive number of seconds")
+
+    return problems
+
+
+def parse_vendor_file(path, content):
+    if path.endswith(".json"):
+        return json.loads(content)
+    try:
+        import yaml
+    except ImportError:
+        raise VendorConfigError(f"{path}: YAML vendor files need PyYAML (pip install pyyaml)") from None
+    return yaml.safe_load(content)
+
+
+def content_key(content):
+    return hashlib.sha256(f"{PLAN_VERSION}\n".encode("utf-8") + content).hexdigest()
+
+
+def read_plan_cache(cache_path):
+    try:
+        with open(cache_path, "r") as file:
+            cache = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return cache.get("plans", {}) if cache.get("version") == PLAN_VERSION else {}
+
+
+def load_vendors(directory="vendors", cache_path=None, update_cache=True):
+    """
+    Load, validate and compile every vendor file in directory, in file name
+    order. Each vendor comes back as its definition plus a "plan" key that
+    build_vendor_formatter uses instead of compiling the mapping again.
+    Plans are cached in cache_path when one is given; with update_cache=False
+    the cache is only read. Raises VendorConfigError listing every problem
+    found, across all files.
+    """
+    if not os.path.isdir(directory):
+        raise VendorConfigError(f"Vendor directory {directory!r} not found")
+
+    cached_plans = read_plan_cache(cache_path) if cache_path else {}
+    plans = {}
+    vendors = []
+    files_by_name = {}
+    problems = []
+
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(VENDOR_FILE_EXTENSIONS):
+            continue
+        path = os.path.join(directory, file_name)
+        with open(path, "rb") as file:
+            content = file.read()
+        key = content_key(content)
+
+        if key in cached_plans:
+            plans[key] = cached_plans[key]
+        else:
+            try:
+                vendor_details = parse_vendor_file(path, content)
+            except VendorConfigError as e:
+                problems.append(str(e))
+                continue
+            except Exception as e:
+                problems.append(f"{path}: can't be parsed: {e}")
+                continue
+
+            file_problems = validate_vendor(vendor_details)
+            if file_problems:
+                problems += [f"{path}: {problem}" for problem in file_problems]
+                continue
+            plan = compile_vendor_plan(vendor_details["columns_order"], vendor_details["mapping"],
+                                       vendor_details.get("defaults", {}))
+            plans[key] = {"vendor": vendor_details, "plan": plan}
+
+        vendor_details = dict(plans[key]["vendor"], plan=plans[key]["plan"])
+        vendors.append(vendor_details)
+        # Checked every time, since a cached plan only vouches for its own file
+        files_by_name.setdefault(vendor_details["vendor_name"], []).append(file_name)
+
+    for vendor_name, file_names in files_by_name.items():
+        if len(file_names) > 1:
+            problems.append(f"vendor_name {vendor_name!r} is used by {', '.join(file_names)}")
+
+    if problems:
+        raise VendorConfigError("Invalid vendor configuration:\n  " + "\n  ".join(problems))
+
+    # Rewritten only when a file was added or changed; plans for edited or removed files are dropped
+    if cache_path and update_cache and plans.keys() != cached_plans.keys():
+        write_atomically(cache_path, json.dumps({"version": PLAN_VERSION, "plans": plans}))
+    return vendors
@@ -0,0 +1,393 @@
+import csv
+import gzip
+import importlib.util
+import io
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+import zlib
+from xml.sax.saxutils import escape
+
+# Characters XML 1.0 doesn't allow, dropped from cell text
+ILLEGAL_XML_CHARACTERS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# Excel won't open a sheet with more rows than this, header included
+XLSX_MAX_ROWS = 1048576
+# Gmail caps a message at 25 MB, counted after encoding. Base64 makes attachments
+# 4/3 bigger plus a line break every 76 characters, so 17 MB of files becomes about
+# 23.3 MB and leaves room for the body and headers. Files (and drafts) are kept under this.
+DEFAULT_MAX_FILE_BYTES = 17_000_000
+
+CONTENT_TYPES_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"><Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/><Default Extension="xml" ContentType="application/xml"/><Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/><Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/><Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/></Types>"""
+
+ROOT_RELS_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/></Relationships>"""
+
+WORKBOOK_RELS_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/><Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/></Relationships>"""
+
+STYLES_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><fonts count="1"><font><sz val="11"/><name val="Calibri"/><family val="2"/><scheme val="minor"/></font></fonts><fills count="2"><fill><patternFill/></fill><fill><patternFill patternType="gray125"/></fill></fills><borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders><cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs><cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs><cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles></styleSheet>"""
+
+WORKBOOK_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets><sheet name="{sheet_name}" sheetId="1" r:id="rId1"/></sheets></workbook>"""
+
+
+def column_letter(column_index):
+    """1 -> A, 27 -> AA"""
+    letters = ""
+    while column_index:
+        column_index, remainder = divmod(column_index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def is_blank(value):
+    # None, NaN and empty strings all end up as an empty cell
+    return value is None or value == "" or (isinstance(value, float) and value != value)
+
+
+class StreamingXlsxWriter:
+    """
+    Writes a single-sheet XLSX in one pass with constant memory.
+
+    Rows are serialized into a temporary sheetData file as they arrive while
+    the widest value of every column is tracked. close() then writes the
+    worksheet with the column widths in front of the spooled rows, so the
+    workbook never has to be reloaded to size its columns.
+
+    Widths follow the old load_workbook pass: the longest str(value) in the
+    column plus 2, where an empty cell counts as "None".
+    """
+    def __init__(self, path, columns, sheet_name="Sheet1"):
+        self.path = path
+        self.columns = list(columns)
+        self.sheet_name = sheet_name
+        self.column_letters = [column_letter(i + 1) for i in range(len(self.columns))]
+        self.widths = [0] * len(self.columns)
+        self.row_count = 0
+        self.rows_file = tempfile.TemporaryFile()
+        # Only used by size_exceeds, once the spooled rows get big
+        self.compressor = None
+        self.compressed_bytes = 0
+        self.compressed_upto = 0
+        self.write_row(self.columns)
+
+    def write_row(self, values):
+        self.row_count += 1
+        row_number = self.row_count
+        cells = []
+
+        for i, value in enumerate(values):
+            if is_blank(value):
+                text_length = 4
+            elif isinstance(value, bool):
+                text_length = len(str(value))
+                cells.append(f'<c r="{self.column_letters[i]}{row_number}" t="b"><v>{int(value)}</v></c>')
+            elif isinstance(value, (int, float)):
+                text = str(value)
+                text_length = len(text)
+                cells.append(f'<c r="{self.column_letters[i]}{row_number}" t="n"><v>{text}</v></c>')
+            else:
+                text = str(value)
+                text_length = len(text)
+                text = escape(ILLEGAL_XML_CHARACTERS.sub("", text))
+                space = ' xml:space="preserve"' if text != text.strip() else ""
+                cells.append(f'<c r="{self.column_letters[i]}{row_number}" t="inlineStr"><is><t{space}>{text}</t></is></c>')
+
+            if text_length > self.widths[i]:
+                self.widths[i] = text_length
+
+        self.rows_file.write(f'<row r="{row_number}">{"".join(cells)}</row>'.encode("utf-8"))
+
+    def write_dicts(self, rows):
+        # Rows missing a column get an empty cell, like pd.DataFrame(rows, columns=...)
+        for row in rows:
+            self.write_row([row.get(column) for column in self.columns])
+
+    def write_rows(self, rows):
+        # Sequences already in column order, e.g. DataFrame.itertuples(index=False, name=None)
+        for values in rows:
+            self.write_row(values)
+
+    def size_exceeds(self, limit):
+        """
+        Whether the workbook would be bigger than limit bytes if closed now.
+        Nothing is compressed while the spooled rows alone are under the limit.
+        After that the rows are deflated the way close() will, to measure the
+        sheet, but only while the ratio measured so far puts it near the
+        limit, so a big workbook with room to spare isn't compressed twice.
+        The other parts of the workbook are a few KB.
+        """
+        spooled_bytes = self.rows_file.tell()
+        if spooled_bytes <= limit:
+            return False
+        if self.compressed_upto and self.compressed_bytes / self.compressed_upto * spooled_bytes < limit * 0.8:
+            return False
+
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.rows_file.seek(self.compressed_upto)
+        while chunk := self.rows_file.read(1024 * 1024):
+            self.compressed_bytes += len(self.compressor.compress(chunk))
+        self.compressed_upto = spooled_bytes
+        return self.compressed_bytes + len(self.compressor.copy().flush()) > limit
+
+    def close(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        last_cell = f"{self.column_letters[-1]}{self.row_count}" if self.columns else "A1"
+        cols = "".join(f'<col min="{i + 1}" max="{i + 1}" width="{width + 2}" customWidth="1"/>'
+                       for i, width in enumerate(self.widths))
+        cols = f"<cols>{cols}</cols>" if cols else ""
+        # Sheets past 2 GiB uncompressed need zip64 headers
+        force_zip64 = self.rows_file.tell() > 2 ** 31 - 2 ** 24
+
+        with zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("[Content_Types].xml", CONTENT_TYPES_XML)
+            archive.writestr("_rels/.rels", ROOT_RELS_XML)
+            archive.writestr("xl/workbook.xml", WORKBOOK_XML.format(sheet_name=escape(self.sheet_name)))
+            archive.writestr("xl/_rels/workbook.xml.rels", WORKBOOK_RELS_XML)
+            archive.writestr("xl/styles.xml", STYLES_XML)
+
+            with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=force_zip64) as sheet:
+                sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                             f'<dimension ref="A1:{last_cell}"/>'
+                             f'{cols}<sheetData>').encode("utf-8"))
+
+                self.rows_file.seek(0)
+                shutil.copyfileobj(self.rows_file, sheet, 1024 * 1024)
+
+                sheet.write(b"</sheetData></worksheet>")
+
+        self.rows_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.rows_file.close()
+
+
+
+class StreamingCsvWriter:
+    """
+    Writes rows straight to a CSV file, gzipped when the path ends in .gz.
+    Much cheaper to write and attach than a workbook. Blank values (None, NaN)
+    are written as empty fields.
+    """
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.raw_file = open(path, "wb")
+        binary_file = gzip.GzipFile(fileobj=self.raw_file, mode="wb") if path.endswith(".gz") else self.raw_file
+        self.file = io.TextIOWrapper(binary_file, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columns)
+
+    def write_row(self, values):
+        self.writer.writerow([None if is_blank(value) else value for value in values])
+
+    def write_dicts(self, rows):
+        for row in rows:
+            self.write_row([row.get(column) for column in self.columns])
+
+    def write_rows(self, rows):
+        for values in rows:
+            self.write_row(values)
+
+    def size_exceeds(self, limit):
+        # Bytes already on disk, compressed when gzipped; a few KB may still be buffered
+        return self.raw_file.tell() > limit
+
+    def close(self):
+        # Closing the wrapper flushes the gzip stream, which leaves raw_file open
+        self.file.close()
+        self.raw_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is not None:
+            # Don't leave a half-written file behind to be attached or archived
+            os.remove(self.path)
+
+
+class ParquetWriter:
+    """
+    Writes rows to a Parquet file in row groups, for our own archive and
+    analytics rather than for vendors. Every column is stored as nullable
+    text, like the CSV, so a column's type can't change between row groups.
+    Needs pyarrow, which is only imported when this format is used.
+    """
+    def __init__(self, path, columns, row_group_size=65536):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError(missing_dependency_message("parquet")) from None
+
+        self.pyarrow = pyarrow
+        self.path = path
+        self.columns = list(columns)
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema([(column, pyarrow.string()) for column in self.columns])
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "wb")
+        self.writer = pyarrow.parquet.ParquetWriter(self.file, self.schema)
+        self.pending = []
+
+    def write_row(self, values):
+        self.pending.append([None if is_blank(value) else str(value) for value in values])
+        if len(self.pending) >= self.row_group_size:
+            self.write_row_group()
+
+    def write_dicts(self, rows):
+        for row in rows:
+            self.write_row([row.get(column) for column in self.columns])
+
+    def write_rows(self, rows):
+        for values in rows:
+            self.write_row(values)
+
+    def write_row_group(self):
+        if self.pending:
+            arrays = [self.pyarrow.array(column_values, self.pyarrow.string()) for column_values in zip(*self.pending)]
+            self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+            self.pending = []
+
+    def size_exceeds(self, limit):
+        # Row groups written so far; the pending one isn't counted
+        return self.file.tell() > limit
+
+    def close(self):
+        self.write_row_group()
+        self.writer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is not None:
+            # Don't leave a half-written file behind to be attached or archived
+            os.remove(self.path)
+
+
+class SplitWriter:
+    """
+    Spreads rows over as many files as it takes to keep each one within
+    max_rows data rows and max_bytes bytes, so no attachment is too big for
+    Excel or Gmail. The first file gets the plain name; once a second one is
+    needed they're renamed name_part1.ext, name_part2.ext, and so on.
+    The size is checked every check_every rows, so a file can go over
+    max_bytes by that many rows. paths lists the files written.
+    """
+    def __init__(self, writer_class, stem, extension, columns, max_rows=None, max_bytes=None, check_every=1000):
+        self.writer_class = writer_class
+        self.stem = stem
+        self.extension = extension
+        self.columns = list(columns)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        self.paths = []
+        self.row_count = 0
+        self.file_rows = 0
+        self.writer = writer_class(f"{stem}{extension}", self.columns)
+
+    def is_full(self):
+        if self.max_rows and self.file_rows >= self.max_rows:
+            return True
+        return bool(self.max_bytes and self.file_rows % self.check_every == 0
+                    and self.writer.size_exceeds(self.max_bytes))
+
+    def next_file(self):
+        self.writer.close()
+        if not self.paths:
+            first_path = f"{self.stem}_part1{self.extension}"
+            os.replace(self.writer.path, first_path)
+            self.paths.append(first_path)
+        else:
+            self.paths.append(self.writer.path)
+        self.writer = self.writer_class(f"{self.stem}_part{len(self.paths) + 1}{self.extension}", self.columns)
+        self.file_rows = 0
+
+    def write_row(self, values):
+        if self.file_rows and self.is_full():
+            self.next_file()
+        self.writer.write_row(values)
+        self.file_rows += 1
+        self.row_count += 1
+
+    def write_dicts(self, rows):
+        for row in rows:
+            self.write_row([row.get(column) for column in self.columns])
+
+    def write_rows(self, rows):
+        for values in rows:
+            self.write_row(values)
+
+    def close(self):
+        self.writer.close()
+        self.paths.append(self.writer.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.__exit__(exc_type, exc_value, traceback)
+
+
+# output format: (file extension, writer class, default max data rows, default max bytes per file)
+OUTPUT_FORMATS = {
+    "xlsx": (".xlsx", StreamingXlsxWriter, XLSX_MAX_ROWS - 1, DEFAULT_MAX_FILE_BYTES),
+    "csv": (".csv", StreamingCsvWriter, None, DEFAULT_MAX_FILE_BYTES),
+    "csv.gz": (".csv.gz", StreamingCsvWriter, None, DEFAULT_MAX_FILE_BYTES),
+    # Archive copies aren't emailed, so they're never split
+    "parquet": (".parquet", ParquetWriter, None, None),
+}
+
+
+# Formats whose writer needs a package that isn't in requirements.txt
+FORMAT_DEPENDENCIES = {"parquet": "pyarrow"}
+
+
+def missing_dependency_message(output_format):
+    """
+    Why output_format can't be written here, or None when it can. The package
+    is looked up without importing it, so vendors can be checked at startup.
+    """
+    package = FORMAT_DEPENDENCIES.get(output_format)
+    if package and importlib.util.find_spec(package) is None:
+        return f"The {output_format} output format needs {package} (pip install {package})"
+    return None
+
+
+def open_writer(output_format, stem, columns, max_rows=None, max_bytes=None):
+    """
+    A SplitWriter for output_format writing to stem + the format's extension.
+    max_rows and max_bytes override the format's defaults; an xlsx file is
+    still never given more rows than Excel can open.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {', '.join(OUTPUT_FORMATS)}")
+    extension, writer_class, default_max_rows, default_max_bytes = OUTPUT_FORMATS[output_format]
+    max_rows = max_rows or default_max_rows
+    if default_max_rows:
+        max_rows = min(max_rows, default_max_rows)
+    return SplitWriter(writer_class, stem, extension, columns, max_rows, max_bytes or default_max_bytes)